@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# Erwan Quelin - erwan.quelin@gmail.com
+
+import argparse
+import hashlib
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from vsanmetrics import buildPerfBatch, formatPerfBatch, perfOutputLines, formatInfluxLineProtocol, parseEntityRefId, convertStrToTimestamp
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the vsanmetrics performance pipeline with synthetic data')
+
+    parser.add_argument('--entities',
+                        type=int,
+                        default=20000,
+                        action='store',
+                        help='Number of entities (series) to generate')
+
+    parser.add_argument('--types',
+                        type=int,
+                        default=8,
+                        action='store',
+                        help='Number of entity types the entities are spread over')
+
+    parser.add_argument('--labels',
+                        type=int,
+                        default=12,
+                        action='store',
+                        help='Number of labels for each entity')
+
+    parser.add_argument('--samples',
+                        type=int,
+                        default=2,
+                        action='store',
+                        help='Number of samples for each label')
+
+    parser.add_argument('--flush',
+                        default='chunk',
+                        choices=['chunk', 'type'],
+                        action='store',
+                        help='Granularity at which both pipelines write their output: by chunks of lines or one string per entity type')
+
+    parser.add_argument('--startup',
+                        action='store_true',
+                        help='Benchmark the start of vsanmetrics instead of the performance pipeline')
+
+    parser.add_argument('--runs',
+                        type=int,
+                        default=10,
+                        action='store',
+                        help='Number of runs of each step of the startup benchmark')
+
+    parser.add_argument('--import-budget',
+                        dest='importBudget',
+                        type=float,
+                        default=100,
+                        action='store',
+                        help='Maximum median duration (ms) of the import of vsanmetrics, the startup benchmark fails above it')
+
+    parser.add_argument('--help-budget',
+                        dest='helpBudget',
+                        type=float,
+                        default=150,
+                        action='store',
+                        help='Maximum median duration (ms) of vsanmetrics --help, the startup benchmark fails above it')
+
+    parser.add_argument('--vsan-budget',
+                        dest='vsanBudget',
+                        type=float,
+                        default=2000,
+                        action='store',
+                        help='Maximum median duration (ms) of the loading of the vSAN API by the first query, the startup benchmark fails above it')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+# Build synthetic results of VsanPerfQueryPerf, the virtual-machine format is used for all the entity types
+def getMetrics(nbEntities, nbTypes, nbLabels, nbSamples):
+
+    labels = ['label%i' % i for i in range(nbLabels)]
+    sampleInfo = ",".join(["2018-05-04 19:%02i:00" % (i * 5) for i in range(nbSamples)])
+
+    vms = {}
+    metrics = [[] for _ in range(nbTypes)]
+
+    for i in range(nbEntities):
+        uuid = '5005a3f4-0000-0000-0000-%012i' % i
+        vms[uuid] = 'vm%i' % i
+
+        values = []
+        for label in labels:
+            values.append(SimpleNamespace(metricId=SimpleNamespace(label=label), values=",".join(["%i.0" % (i + j) for j in range(nbSamples)])))
+
+        metrics[i % nbTypes].append(SimpleNamespace(entityRefId='virtual-machine:' + uuid, sampleInfo=sampleInfo, value=values))
+
+    return labels, vms, metrics
+
+
+# Write lines to the output by chunks of lines, or all at once without chunkLines
+def writeLines(lines, output, chunkLines):
+
+    chunk = []
+
+    for line in lines:
+        chunk.append(line)
+
+        if chunkLines and len(chunk) >= chunkLines:
+            output.update("".join(chunk).encode())
+            chunk = []
+
+    if chunk:
+        output.update("".join(chunk).encode())
+
+
+# Pipeline used before the columnar batches: one dict of tags and one dict of fields per entity
+# The entities of an entity type are all parsed before being written, as the rollups and the merge of the shards need them
+def runLegacy(metricsByType, labels, tagsbase, vms, output, chunkLines):
+
+    for metrics in metricsByType:
+
+        rows = []
+
+        for metric in metrics:
+
+            sampleInfos = metric.sampleInfo.split(",")
+            lenValues = len(sampleInfos)
+
+            timestamp = convertStrToTimestamp(sampleInfos[lenValues - 1])
+
+            tags = parseEntityRefId('virtual-machine', metric.entityRefId, {}, vms, {})
+            tags.update(tagsbase)
+
+            fields = {}
+
+            for value in metric.value:
+                listValue = value.values.split(",")
+                fields[value.metricId.label] = float(listValue[lenValues - 1])
+
+            rows.append((tags, fields, timestamp))
+
+        writeLines((formatInfluxLineProtocol('virtual-machine', tags, fields, timestamp) for tags, fields, timestamp in rows), output, chunkLines)
+
+
+# Pipeline of getPerformance: one columnar batch per entity type
+def runBatch(metricsByType, labels, tagsbase, vms, output, chunkLines):
+
+    for metrics in metricsByType:
+        batch = buildPerfBatch('virtual-machine', metrics, labels, {}, vms, {})
+
+        for chunk in formatPerfBatch(batch, tagsbase, chunkLines or len(batch['tags']) or 1):
+            output.update(chunk.encode())
+
+
+# Return the digest of the output, the duration and the peak of memory allocated by a pipeline
+def measure(pipeline, metricsByType, labels, tagsbase, vms, chunkLines):
+
+    output = hashlib.sha1()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    pipeline(metricsByType, labels, tagsbase, vms, output, chunkLines)
+
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return output.hexdigest(), duration, peak
+
+
+# Durations (ms) of a command run in a new interpreter, None if it fails
+# With measured, the command prints its own duration (seconds) instead of the duration of the process
+def measureStartup(command, runs, measured=False):
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    durations = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + command, cwd=folder, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        duration = time.perf_counter() - start
+
+        if result.returncode != 0:
+            return None
+
+        if measured:
+            duration = float(result.stdout.decode().strip().splitlines()[-1])
+
+        durations.append(duration * 1000)
+
+    return durations
+
+
+# Modules loaded on first use, the import of vsanmetrics must not load them
+lazyModules = ('pyVim', 'pyVmomi', 'vsanapiutils', 'vsanmgmtObjects', 'asyncio', 'multiprocessing', 'concurrent.futures')
+
+
+# Lazy modules loaded by the import of vsanmetrics, in a new interpreter
+def getEagerModules():
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    command = "import sys, vsanmetrics; print(' '.join(name for name in %r if name in sys.modules))" % (lazyModules,)
+
+    result = subprocess.run([sys.executable, '-c', command], cwd=folder, stdout=subprocess.PIPE, check=True)
+
+    return result.stdout.decode().split()
+
+
+# Start of the script: interpreter alone, import of vsanmetrics, --help, and loading of the vSAN API by the first query
+# Return 1 if a lazy module is loaded at import or if a step is over its budget
+def runStartup(args):
+
+    steps = []
+    steps.append(('python', ['-c', 'pass'], False, None))
+    steps.append(('import vsanmetrics', ['-c', 'import vsanmetrics'], False, args.importBudget))
+    steps.append(('vsanmetrics --help', ['vsanmetrics.py', '--help'], False, args.helpBudget))
+    steps.append(('first query (vSAN API load)', ['-c', 'import time, vsanmetrics; start = time.perf_counter(); vsanmetrics.loadVsanModules(); print(time.perf_counter() - start)'], True, args.vsanBudget))
+
+    # The bytecode of vsanmetrics is compiled first, as for an installed script, even if the interpreters don't write it
+    py_compile.compile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vsanmetrics.py'), doraise=True)
+
+    print("|Step|Median (ms)|Max (ms)|Budget (ms)|")
+    print("|---|---|---|---|")
+
+    failures = []
+
+    for name, command, measured, budget in steps:
+        durations = measureStartup(command, args.runs, measured)
+        budgetString = '' if budget is None else '%.1f' % (budget)
+
+        if durations is None:
+            print("|%s|n/a|n/a|%s|" % (name, budgetString))
+
+            # Without the vSAN SDK, the vSAN API can't be loaded: its step is skipped
+            if not measured:
+                failures.append("%s failed" % (name))
+            continue
+
+        print("|%s|%.1f|%.1f|%s|" % (name, statistics.median(durations), max(durations), budgetString))
+
+        if budget is not None and statistics.median(durations) > budget:
+            failures.append("%s is over its budget of %.1f ms" % (name, budget))
+
+    eagerModules = getEagerModules()
+
+    if eagerModules:
+        failures.append("the import of vsanmetrics loads %s" % (', '.join(eagerModules)))
+
+    for failure in failures:
+        print("The start of vsanmetrics is too slow: " + failure)
+
+    return 1 if failures else 0
+
+
+# Main...
+def main():
+
+    args = get_args()
+
+    if args.startup:
+        return runStartup(args)
+
+    tagsbase = {}
+    tagsbase['vcenter'] = 'vcenter.example.com'
+    tagsbase['cluster'] = 'VSAN-CLUSTER'
+
+    # Both pipelines write their output at the same granularity, only the representation of the samples differs
+    chunkLines = perfOutputLines if args.flush == 'chunk' else None
+
+    print("|Entity types|Pipeline|Duration (s)|Peak memory (MiB)|")
+    print("|---|---|---|---|")
+
+    # A single entity type holding all the entities is the worst case of the memory of a type (ex: virtual-disk)
+    for nbTypes in sorted(set([args.types, 1]), reverse=True):
+
+        labels, vms, metricsByType = getMetrics(args.entities, nbTypes, args.labels, args.samples)
+
+        results = {}
+
+        for name, pipeline in (('legacy', runLegacy), ('batch', runBatch)):
+            results[name], duration, peak = measure(pipeline, metricsByType, labels, tagsbase, vms, chunkLines)
+            print("|%i|%s|%.3f|%.1f|" % (nbTypes, name, duration, peak / 1048576.0))
+
+        if results['legacy'] != results['batch']:
+            print("The outputs of the pipelines are different")
+            return 1
+
+    return 0
+
+
+# Start program
+if __name__ == "__main__":
+    exit(main())
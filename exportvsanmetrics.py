@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Erwan Quelin - erwan.quelin@gmail.com
+
+import argparse
+import json
+import math
+import os
+
+from vsanmetrics import readArchiveChunk, listArchiveChunks, formatInfluxLineProtocol, convertStrToTimestamp
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Query and export the local archive of vsanmetrics')
+
+    parser.add_argument('-a', '--archive',
+                        required=True,
+                        action='store',
+                        help='Folder of the archive (--archive of vsanmetrics)')
+
+    parser.add_argument('-s', '--vcenter',
+                        required=False,
+                        action='store',
+                        help='Only export the clusters of this vCenter')
+
+    parser.add_argument('-c', '--cluster',
+                        required=False,
+                        action='store',
+                        help='Only export this cluster')
+
+    parser.add_argument('-m', '--measurement',
+                        required=False,
+                        action='append',
+                        default=[],
+                        help='Only export this measurement, can be used several times')
+
+    parser.add_argument('--start',
+                        required=False,
+                        action='store',
+                        help='Only export the results collected from this time (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)')
+
+    parser.add_argument('--end',
+                        required=False,
+                        action='store',
+                        help='Only export the results collected before this time (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)')
+
+    parser.add_argument('--tag',
+                        required=False,
+                        action='append',
+                        default=[],
+                        help='Only export the results with this tag value (key=value), can be used several times')
+
+    parser.add_argument('--fields',
+                        required=False,
+                        action='store',
+                        help='Comma separated list of the fields to export, the other columns are not decompressed')
+
+    parser.add_argument('--format',
+                        required=False,
+                        default='influx',
+                        choices=['influx', 'json'],
+                        action='store',
+                        help='Output format: InfluxDB line protocol or one JSON object per line')
+
+    args = parser.parse_args()
+
+    if args.fields:
+        args.fields = args.fields.split(',')
+
+    args.tags = {}
+
+    for tag in args.tag:
+        if '=' not in tag:
+            print("Invalid tag filter: " + tag + ", the format is key=value")
+            exit(1)
+
+        key, value = tag.split('=', 1)
+        args.tags[key] = value
+
+    return args
+
+
+# Convert a time filter to a timestamp in nanoseconds
+def convertTimeFilter(value):
+
+    if value is None:
+        return None
+
+    if len(value) == 10:
+        value = value + " 00:00:00"
+
+    return convertStrToTimestamp(value)
+
+
+# List the chunk files of the archive matching the filters, days are pruned with the name of their partition
+def getChunkFiles(args):
+
+    chunkFiles = []
+
+    for vcenter in sorted(os.listdir(args.archive)):
+        if args.vcenter and vcenter != args.vcenter:
+            continue
+
+        for cluster in sorted(os.listdir(os.path.join(args.archive, vcenter))):
+            if args.cluster and cluster != args.cluster:
+                continue
+
+            for measurement in sorted(os.listdir(os.path.join(args.archive, vcenter, cluster))):
+                if args.measurement and measurement not in args.measurement:
+                    continue
+
+                for day in sorted(os.listdir(os.path.join(args.archive, vcenter, cluster, measurement))):
+                    if args.start and day < args.start[:10]:
+                        continue
+                    if args.end and day > args.end[:10]:
+                        continue
+
+                    folder = os.path.join(args.archive, vcenter, cluster, measurement, day)
+
+                    # Chunks merged in a compacted chunk are skipped
+                    for filename in listArchiveChunks(folder)[0]:
+                        chunkFiles.append((vcenter, cluster, os.path.join(folder, filename)))
+
+    return chunkFiles
+
+
+# Print the rows of a chunk matching the filters
+def exportChunk(args, vcenter, cluster, table, start, end):
+
+    tagKeys = list(table['tags'])
+    fieldKeys = list(table['fields'])
+
+    for row, timestamp in enumerate(table['timestamps']):
+
+        if start is not None and timestamp < start:
+            continue
+        if end is not None and timestamp >= end:
+            continue
+
+        tags = {}
+        tags['vcenter'] = vcenter
+        tags['cluster'] = cluster
+
+        for key in tagKeys:
+            if table['tags'][key][row] != '':
+                tags[key] = table['tags'][key][row]
+
+        if any(tags.get(key) != value for key, value in args.tags.items()):
+            continue
+
+        fields = {}
+
+        for key in fieldKeys:
+            value = table['fields'][key][row]
+
+            # Missing values are stored as NaN in the numeric columns and as empty strings in the string columns
+            if isinstance(value, float) and math.isnan(value):
+                continue
+            if value == '':
+                continue
+
+            fields[key] = value
+
+        if not fields:
+            continue
+
+        if args.format == 'json':
+            print(json.dumps({'measurement': table['measurement'], 'time': timestamp, 'tags': tags, 'fields': fields}))
+        else:
+            for key, value in fields.items():
+                if isinstance(value, str):
+                    fields[key] = '"' + value + '"'
+
+            print(formatInfluxLineProtocol(table['measurement'], tags, fields, timestamp), end='')
+
+
+# Main...
+def main():
+
+    args = get_args()
+
+    start = convertTimeFilter(args.start)
+    end = convertTimeFilter(args.end)
+
+    for vcenter, cluster, filename in getChunkFiles(args):
+        exportChunk(args, vcenter, cluster, readArchiveChunk(filename, args.fields), start, end)
+
+    return 0
+
+
+# Start program
+if __name__ == "__main__":
+    exit(main())
@@ -15,6 +15,8 @@ import ssl
 import vsanapiutils
 import vsanmgmtObjects
 
+from vsanmetrics import getEntityTypes
+
 
 def get_args():  
     parser = argparse.ArgumentParser(
@@ -53,6 +55,12 @@ def get_args():
                     required=True,
                     help='Output Format, markdown or HTML')
 
+    parser.add_argument('--cachefolder',
+                        default='.',
+                        required=False,
+                        action='store',
+                        help='Folder where the cache files are stored')
+
     args = parser.parse_args()
     if not args.password:
         args. password = getpass.getpass(
@@ -117,81 +125,79 @@ def main():
     
     # Exit if the cluster provided in the arguments is not available
     if not cluster_obj:
-        print 'The required cluster not found in inventory, validate input. Aborting test'
+        print('The required cluster not found in inventory, validate input. Aborting test')
         exit()
 
     apiVersion = vsanapiutils.GetLatestVmodlVersion(args.vcenter)
     vcMos = vsanapiutils.GetVsanVcMos(si._stub, context=context, version=apiVersion)
 
-    vsanPerfSystem =  vcMos['vsan-performance-manager']
-
     # Gather a list of the available entity types (ex: vsan-host-net)
-    entityTypes = vsanPerfSystem.VsanPerfGetSupportedEntityTypes()
+    entityTypes = getEntityTypes(args.cachefolder, content, vcMos)
 
     if (args.format).lower() == 'raw':
-        print entityTypes
+        print(entityTypes)
 
     if (args.format).lower() == 'markdown':
 
-        print"## Entity types"
-        print""
+        print("## Entity types")
+        print("")
         print("|Name|Description|")
         print("|---|---|")
 
         for entities in entityTypes:
-            print "|%s|%s|" % (entities.name,entities.description)
+            print("|%s|%s|" % (entities['name'],entities['description']))
 
-        print ""
-        print"## Details"
+        print("")
+        print("## Details")
         for entities in entityTypes:
 
-            print ""
-            print "### %s" % (entities.name)
-            print ""
-            print entities.description
-            print ""
+            print("")
+            print("### %s" % (entities['name']))
+            print("")
+            print(entities['description'])
+            print("")
             print("|Label|Name|Unit|Description|")
             print("|---|---|---|---|")
 
-            for entity in entities.graphs:
+            for entity in entities['graphs']:
 
-                unit = entity.unit
+                unit = entity['unit']
 
-                for metric in entity.metrics:
+                for metric in entity['metrics']:
 
-                    print "|%s|%s|%s|%s|" % (metric.label,metric.name,unit,metric.description)
-        print ""
+                    print("|%s|%s|%s|%s|" % (metric['label'],metric['name'],unit,metric['description']))
+        print("")
 
     if (args.format).lower() == 'html':
         print("<table>")
         print("<thead><tr><th>Name</th><th>Description</th></tr></thead>")
         print("<tbody>")
         for entities in entityTypes:
-            print "<tr><th>%s</th><th>%s</th></tr>" % (entities.name,entities.description)
+            print("<tr><th>%s</th><th>%s</th></tr>" % (entities['name'],entities['description']))
 
         print("</tbody>")
         print("</table>")
-        print ""
+        print("")
         for entities in entityTypes:
 
-            print "<h3> %s </h3>" % (entities.name)
-            print ""
-            print entities.description
-            print ""
+            print("<h3> %s </h3>" % (entities['name']))
+            print("")
+            print(entities['description'])
+            print("")
             print("<table>")
             print("<thead><tr><th>Label</th><th>Name</th><th>Unit</th><th>Description</th></tr></thead>")
             print("<tbody>")
 
-            for entity in entities.graphs:
+            for entity in entities['graphs']:
 
-                unit = entity.unit
+                unit = entity['unit']
 
-                for metric in entity.metrics:
+                for metric in entity['metrics']:
 
-                    print "<tr><th>%s</th><th>%s</th><th>%s</th><th>%s</th></tr>" % (metric.label,metric.name,unit,metric.description)
+                    print("<tr><th>%s</th><th>%s</th><th>%s</th><th>%s</th></tr>" % (metric['label'],metric['name'],unit,metric['description']))
             print("</tbody>")
             print("</table>")
-            print ""
+            print("")
 
     return 0
 
@@ -0,0 +1,130 @@
+import math
+import os
+import shutil
+import types
+
+import exportvsanmetrics
+import vsanmetrics
+
+timestamp = vsanmetrics.convertStrToTimestamp('2024-01-02 12:00:00')
+
+
+def newArchive(tmp_path, run):
+    args = types.SimpleNamespace(archive=str(tmp_path), vcenter='vc1', clusterName='CL1', archiveCompact=4)
+
+    archive = vsanmetrics.newArchive(args)
+    archive['run'] = run
+
+    return archive
+
+
+# Write the rows of a run in a chunk, return the folder of its partition
+def writeChunk(tmp_path, run, rows):
+    archive = newArchive(tmp_path, run)
+
+    vsanmetrics.writeArchiveChunk(archive, vsanmetrics.rowsToTable('capacity', rows))
+
+    return list(archive['partitions'])[0]
+
+
+def getCompactedHeader(folder):
+    filenames = os.listdir(folder)
+
+    assert len(filenames) == 1 and filenames[0].startswith('compact-')
+
+    return vsanmetrics.readArchiveChunkHeader(os.path.join(folder, filenames[0]))
+
+
+def readPartition(folder):
+    return [vsanmetrics.readArchiveChunk(os.path.join(folder, filename)) for filename in vsanmetrics.listArchiveChunks(folder)[0]]
+
+
+def exportPartition(folder, capsys):
+    args = types.SimpleNamespace(tags={}, format='influx')
+
+    for table in readPartition(folder):
+        exportvsanmetrics.exportChunk(args, 'vc1', 'CL1', table, None, None)
+
+    return capsys.readouterr().out
+
+
+def test_compaction_remaps_the_dictionaries(tmp_path, capsys):
+    writeChunk(tmp_path, 1000, [({'hostname': 'h1'}, {'usedB': 1}, timestamp), ({'hostname': 'h2'}, {'usedB': 2}, timestamp + 1),
+                                ({'hostname': 'h1'}, {'usedB': 3}, timestamp + 2)])
+    writeChunk(tmp_path, 1001, [({'hostname': 'h3'}, {'usedB': 4}, timestamp + 3), ({'hostname': 'h1'}, {'usedB': 5}, timestamp + 4)])
+
+    # A column missing in a chunk is empty for its rows
+    folder = writeChunk(tmp_path, 1002, [({'disk': 'd1'}, {'usedB': 6, 'freeB': 7}, timestamp + 5)])
+
+    exported = exportPartition(folder, capsys)
+
+    vsanmetrics.compactArchivePartition(folder)
+
+    header = getCompactedHeader(folder)
+    columns = dict((column['name'], column) for column in header['columns'])
+
+    assert header['rows'] == 6
+    assert columns['hostname']['dictionary'] == ['h1', 'h2', 'h3', '']
+    assert columns['usedB']['type'] == 'd'
+
+    table, = readPartition(folder)
+
+    assert list(table['timestamps']) == [timestamp + row for row in range(6)]
+    assert table['tags']['hostname'] == ['h1', 'h2', 'h1', 'h3', 'h1', '']
+    assert table['tags']['disk'] == ['', '', '', '', '', 'd1']
+    assert list(table['fields']['usedB']) == [1, 2, 3, 4, 5, 6]
+    assert [math.isnan(value) for value in table['fields']['freeB']] == [True] * 5 + [False]
+
+    # The export is the same before and after the compaction
+    assert exportPartition(folder, capsys) == exported
+
+
+def test_compaction_of_mixed_numeric_and_string_columns(tmp_path):
+    writeChunk(tmp_path, 1000, [({'uuid': 'a'}, {'status': 1, 'usedB': 10}, timestamp), ({'uuid': 'b'}, {'status': 2.5, 'usedB': 11}, timestamp + 1)])
+    writeChunk(tmp_path, 1001, [({'uuid': 'c'}, {'status': '"green"', 'usedB': 12}, timestamp + 2)])
+    folder = writeChunk(tmp_path, 1002, [({'uuid': 'd'}, {'usedB': 13}, timestamp + 3)])
+
+    vsanmetrics.compactArchivePartition(folder)
+
+    columns = dict((column['name'], column) for column in getCompactedHeader(folder)['columns'])
+
+    # A field stored as strings in one chunk is stored as strings, the numbers keep their format
+    assert columns['status']['type'] == 'dictionary'
+    assert columns['usedB']['type'] == 'd'
+
+    table, = readPartition(folder)
+
+    assert table['fields']['status'] == ['1', '2.5', 'green', '']
+    assert list(table['fields']['usedB']) == [10, 11, 12, 13]
+    assert table['tags']['uuid'] == ['a', 'b', 'c', 'd']
+
+
+def test_interrupted_compaction_is_not_merged_twice(tmp_path, capsys):
+    for run in range(1000, 1003):
+        folder = writeChunk(tmp_path, run, [({'hostname': 'h%i' % run}, {'usedB': run}, timestamp + run)])
+
+    exported = exportPartition(folder, capsys)
+    sources = os.path.join(str(tmp_path), 'sources')
+    shutil.copytree(folder, sources)
+
+    vsanmetrics.compactArchivePartition(folder)
+
+    # The compaction stopped before deleting the merged chunks: they are hidden, then deleted by the next compaction
+    for filename in os.listdir(sources):
+        shutil.copy(os.path.join(sources, filename), folder)
+
+    assert len(vsanmetrics.listArchiveChunks(folder)[0]) == 1
+    assert exportPartition(folder, capsys) == exported
+
+    vsanmetrics.compactArchivePartition(folder)
+
+    assert getCompactedHeader(folder)['rows'] == 3
+
+    # A new chunk is merged with the compacted one
+    writeChunk(tmp_path, 1003, [({'hostname': 'h1003'}, {'usedB': 1003}, timestamp + 1003)])
+    vsanmetrics.compactArchivePartition(folder)
+
+    table, = readPartition(folder)
+
+    assert sorted(table['tags']['hostname']) == ['h1000', 'h1001', 'h1002', 'h1003']
+    assert getCompactedHeader(folder)['rows'] == 4
@@ -0,0 +1,174 @@
+import types
+
+import pytest
+
+import vsanmetrics
+
+pyVmomi = pytest.importorskip('pyVmomi')
+
+
+@pytest.fixture
+def vsanModules():
+    try:
+        vsanmetrics.loadVsanModules()
+    except ImportError:
+        # The inventory of the objects only needs pyVmomi
+        pass
+
+
+# vSAN object system of a fake cluster, recording the listings by type and the pages of space summaries
+class FakeObjectSystem(object):
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.listings = []
+        self.pages = []
+
+    def VsanQueryObjectIdentities(self, cluster, objUuids=None, objTypes=None, includeObjIdentity=False, includeSpaceSummary=False):
+        if includeObjIdentity:
+            assert objTypes != ['vdisk']
+            self.listings.append(objTypes[0])
+
+            identities = [types.SimpleNamespace(uuid=uuid, type=objType, vmInstanceUuid=vm)
+                          for uuid, (objType, vm) in self.objects.items() if objType == objTypes[0]]
+
+            return types.SimpleNamespace(identities=identities, spaceSummary=None)
+
+        self.pages.append(list(objUuids))
+
+        spaceSummary = [types.SimpleNamespace(objUuid=uuid, overheadB=0, overReservedB=0, physicalUsedB=1, primaryCapacityB=1,
+                                              reservedCapacityB=0, temporaryOverheadB=0, usedB=2, provisionCapacityB=0)
+                        for uuid in objUuids]
+
+        return types.SimpleNamespace(identities=None, spaceSummary=spaceSummary)
+
+
+def getArgs(tmp_path):
+    return types.SimpleNamespace(cachefolder=str(tmp_path), vcenter='vc1', clusterName='CL1', cacheTTL=60,
+                                 capacityThreads=2, capacityPageSize=2)
+
+
+def getSpaceReport(usedByType):
+    return types.SimpleNamespace(spaceDetail=types.SimpleNamespace(spaceUsageByObjectType=[
+        types.SimpleNamespace(objType=objType, usedB=usedB) for objType, usedB in usedByType.items()]))
+
+
+def collect(args, objectSystem, vmDisks, usedByType):
+    vsanmetrics.getCapacityObjects(args, {'cluster': 'CL1'}, None, {'vsan-cluster-object-system': objectSystem},
+                                   {'vm-1': 'vm01'}, vmDisks, getSpaceReport(usedByType), 0)
+
+
+def test_types_expire_on_their_listing_time(tmp_path, monkeypatch, capsys, vsanModules):
+    args = getArgs(tmp_path)
+    objectSystem = FakeObjectSystem({'swap-1': ('vmswap', 'vm-1'), 'ns-1': ('namespace', 'vm-1')})
+    vmDisks = {'vm-1': [{'objects': ['disk-1', 'snapshot-1']}, {'objects': ['disk-2']}]}
+    now = [1000000.0]
+
+    monkeypatch.setattr(vsanmetrics.time, 'time', lambda: now[0])
+
+    collect(args, objectSystem, vmDisks, {'vdisk': 10, 'vmswap': 20, 'namespace': 30})
+
+    # vdisk is never listed by vSAN, its objects come from the disks of the VMs and are queried by pages
+    assert sorted(objectSystem.listings) == ['namespace', 'vmswap']
+    assert sorted(uuid for page in objectSystem.pages for uuid in page) == ['disk-1', 'disk-2', 'ns-1', 'snapshot-1', 'swap-1']
+    assert max(len(page) for page in objectSystem.pages) == 2
+
+    output = capsys.readouterr().out
+    assert 'capacity_object,uuid=snapshot-1,type=vdisk,vmname=vm01' in output
+    assert 'capacity_vm,uuid=vm-1,vmname=vm01' in output
+
+    # The cache file is rewritten at each run, only the types listed more than the TTL ago are listed again
+    objectSystem.listings, objectSystem.pages = [], []
+    now[0] += 40 * 60
+    collect(args, objectSystem, vmDisks, {'vdisk': 10, 'vmswap': 20, 'namespace': 31})
+
+    assert objectSystem.listings == ['namespace']
+
+    objectSystem.listings, objectSystem.pages = [], []
+    now[0] += 30 * 60
+    collect(args, objectSystem, vmDisks, {'vdisk': 10, 'vmswap': 20, 'namespace': 31})
+
+    assert objectSystem.listings == ['vmswap']
+    assert sorted(uuid for page in objectSystem.pages for uuid in page) == ['disk-1', 'disk-2', 'snapshot-1', 'swap-1']
+
+    # The objects of the cache are still written
+    assert 'capacity_object,uuid=ns-1,type=namespace' in capsys.readouterr().out
+
+
+def test_vdisk_without_vm_disks_is_listed_again(tmp_path, monkeypatch, capsys, vsanModules):
+    args = getArgs(tmp_path)
+    objectSystem = FakeObjectSystem({})
+
+    collect(args, objectSystem, None, {'vdisk': 10})
+
+    assert objectSystem.pages == []
+
+    collect(args, objectSystem, {'vm-1': [{'objects': ['disk-1']}]}, {'vdisk': 10})
+
+    assert objectSystem.pages == [['disk-1']]
+
+
+def test_vm_disks_from_devices(vsanModules):
+    vim = pyVmomi.vim
+
+    snapshot = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName='[vsanDatastore] vm01/vm01.vmdk', backingObjectId='disk-1')
+    delta = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName='[vsanDatastore] vm01/vm01-000001.vmdk', backingObjectId='delta-1', parent=snapshot)
+    vsanDisk = vim.vm.device.VirtualDisk(key=2000, backing=delta, controllerKey=1000, unitNumber=0)
+    localDisk = vim.vm.device.VirtualDisk(key=16000, backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName='[local] vm01/vm01_1.vmdk'), controllerKey=15000, unitNumber=1)
+    controllers = [vim.vm.device.ParaVirtualSCSIController(key=1000, busNumber=0), vim.vm.device.VirtualAHCIController(key=15000, busNumber=0)]
+
+    assert vsanmetrics.parseVMDisks(controllers + [vsanDisk, localDisk]) == [{'objects': ['delta-1', 'disk-1'], 'key': 2000, 'node': 'scsi0:0'},
+                                                                             {'objects': [], 'key': 16000, 'node': 'sata0:1'}]
+
+
+# Property collector of a fake cluster, sending the VMs by pages
+class FakePropertyCollector(object):
+
+    def __init__(self, vms, pageSize):
+        self.vms = vms
+        self.pageSize = pageSize
+        self.calls = 0
+
+    def getPage(self, offset):
+        self.calls += 1
+
+        objects = []
+
+        for uuid, devices in self.vms[offset:offset + self.pageSize]:
+            propSet = [types.SimpleNamespace(name='config.hardware.device', val=devices)]
+
+            if uuid:
+                propSet.append(types.SimpleNamespace(name='config.instanceUuid', val=uuid))
+
+            objects.append(types.SimpleNamespace(propSet=propSet))
+
+        token = str(offset + self.pageSize) if offset + self.pageSize < len(self.vms) else None
+
+        return types.SimpleNamespace(objects=objects, token=token)
+
+    def RetrievePropertiesEx(self, specSet, options):
+        assert options.maxObjects == vsanmetrics.vmDisksPageSize
+
+        return self.getPage(0)
+
+    def ContinueRetrievePropertiesEx(self, token):
+        return self.getPage(int(token))
+
+
+def test_vm_disks_are_retrieved_by_pages(monkeypatch, vsanModules):
+    vim = pyVmomi.vim
+
+    monkeypatch.setattr(vsanmetrics, 'vmDisksPageSize', 2)
+
+    disk = vim.vm.device.VirtualDisk(key=2000, backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(backingObjectId='disk-1'), controllerKey=1000, unitNumber=0)
+
+    # The inaccessible VM has no configuration
+    vms = [('vm-1', [disk]), ('vm-2', []), (None, []), ('vm-4', [])]
+    propertyCollector = FakePropertyCollector(vms, 2)
+    content = types.SimpleNamespace(propertyCollector=propertyCollector)
+
+    vmDisks = vsanmetrics.queryVMDisks(content, vim.ClusterComputeResource('domain-c1'))
+
+    # The disk of an unknown controller has no virtual device node
+    assert vmDisks == {'vm-1': [{'objects': ['disk-1'], 'key': 2000, 'node': None}], 'vm-2': [], 'vm-4': []}
+    assert propertyCollector.calls == 2
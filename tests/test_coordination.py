@@ -0,0 +1,164 @@
+import json
+import os
+import time
+import types
+
+import vsanmetrics
+
+
+# State of an instance of the fleet sharing the coordination folder
+def newInstance(tmp_path, name):
+    fleet = {'coordination': str(tmp_path), 'instance': name, 'membertimeout': 60, 'interval': 300, 'collecting': set()}
+
+    vsanmetrics.registerFleetMember(fleet)
+
+    return fleet
+
+
+def getClusters(count):
+    return [types.SimpleNamespace(vcenter='vc%i' % (index % 3), clusterName='CL%i' % index) for index in range(count)]
+
+
+def getLeaseHolder(fleet, args):
+    lease = vsanmetrics.readFleetFile(vsanmetrics.getFleetLeaseFilename(fleet, args))
+
+    return lease['instance'] if lease else None
+
+
+# The instance stops sending its heartbeat, it is dead for the others once the member timeout is over
+def killInstance(fleet):
+    filename = os.path.join(fleet['coordination'], 'members', fleet['instance'])
+
+    with open(filename, 'w') as fileObject:
+        json.dump({'instance': fleet['instance'], 'heartbeat': time.time() - fleet['membertimeout'] - 1}, fileObject)
+
+
+def test_owner_only_moves_to_the_joining_instance():
+    clusters = ['vc/CL%i' % index for index in range(200)]
+
+    before = dict((key, vsanmetrics.getFleetOwner(set(['a', 'b']), key)) for key in clusters)
+    after = dict((key, vsanmetrics.getFleetOwner(set(['a', 'b', 'c']), key)) for key in clusters)
+
+    assert all(after[key] in (before[key], 'c') for key in clusters)
+
+    # The virtual nodes spread the clusters over the instances
+    assert 40 < list(after.values()).count('c') < 100
+
+
+def test_handover_when_an_instance_joins_and_dies(tmp_path):
+    clusters = getClusters(60)
+    a = newInstance(tmp_path, 'a')
+
+    assert all(vsanmetrics.acquireFleetLease(a, args) is True for args in clusters)
+
+    b = newInstance(tmp_path, 'b')
+    movedToB = [args for args in clusters if vsanmetrics.getFleetOwner(set(['a', 'b']), args.vcenter + '/' + args.clusterName) == 'b']
+
+    assert 0 < len(movedToB) < len(clusters)
+
+    # b waits for the lease of a, a keeps the leases of the clusters being collected at its heartbeat
+    assert all(vsanmetrics.acquireFleetLease(b, args) is None for args in movedToB)
+
+    a['collecting'].add(movedToB[0].vcenter + '/' + movedToB[0].clusterName)
+    vsanmetrics.releaseFleetLeases(a)
+
+    assert getLeaseHolder(a, movedToB[0]) == 'a'
+    assert all(getLeaseHolder(a, args) is None for args in movedToB[1:])
+
+    # At its next run, a doesn't collect the cluster which moved and releases its lease
+    assert vsanmetrics.acquireFleetLease(a, movedToB[0]) is False
+    assert all(vsanmetrics.acquireFleetLease(b, args) is True for args in movedToB)
+
+    # The clusters of a are renewed by a, they never move to b
+    assert all(vsanmetrics.acquireFleetLease(a, args) is True for args in clusters if args not in movedToB)
+    assert all(vsanmetrics.acquireFleetLease(b, args) is False for args in clusters if args not in movedToB)
+
+    # b dies: its leases are still valid, they are taken over by a
+    killInstance(b)
+
+    assert all(vsanmetrics.acquireFleetLease(a, args) is True for args in clusters)
+    assert all(getLeaseHolder(a, args) == 'a' for args in clusters)
+    assert sorted(os.listdir(os.path.join(str(tmp_path), 'leases'))) == sorted(os.path.basename(vsanmetrics.getFleetLeaseFilename(a, args)) for args in clusters)
+
+
+def test_stopped_instance_hands_over_at_once(tmp_path):
+    clusters = getClusters(30)
+    a = newInstance(tmp_path, 'a')
+    b = newInstance(tmp_path, 'b')
+
+    for args in clusters:
+        vsanmetrics.acquireFleetLease(a, args)
+        vsanmetrics.acquireFleetLease(b, args)
+
+    vsanmetrics.unregisterFleetMember(b)
+
+    assert all(vsanmetrics.acquireFleetLease(a, args) is True for args in clusters)
+
+
+# Two instances both own a cluster whose lease is held by a dead instance, each of them only sees itself
+def raceInstances(tmp_path, monkeypatch):
+    dead = newInstance(tmp_path, 'dead')
+    a = newInstance(tmp_path, 'a')
+    c = newInstance(tmp_path, 'c')
+    args = getClusters(1)[0]
+
+    monkeypatch.setattr(vsanmetrics, 'getFleetMembers', lambda fleet: set([fleet['instance']]))
+    monkeypatch.setattr(vsanmetrics, 'getFleetOwner', lambda members, key: list(members)[0])
+
+    assert vsanmetrics.acquireFleetLease(dead, args) is True
+    killInstance(dead)
+
+    return a, c, args
+
+
+def test_lease_taken_over_while_renamed(tmp_path, monkeypatch):
+    a, c, args = raceInstances(tmp_path, monkeypatch)
+    rename = os.rename
+
+    # c takes the stale lease over between the read and the rename of a: a moves the new lease of c away
+    def racingRename(source, destination):
+        monkeypatch.setattr(os, 'rename', rename)
+        assert vsanmetrics.acquireFleetLease(c, args) is True
+        rename(source, destination)
+
+    monkeypatch.setattr(os, 'rename', racingRename)
+
+    # a puts the lease of c back and doesn't collect the cluster
+    assert vsanmetrics.acquireFleetLease(a, args) is None
+    assert getLeaseHolder(a, args) == 'c'
+    assert os.listdir(os.path.join(str(tmp_path), 'leases')) == [os.path.basename(vsanmetrics.getFleetLeaseFilename(a, args))]
+
+
+def test_lease_moved_away_by_another_instance(tmp_path, monkeypatch):
+    a, c, args = raceInstances(tmp_path, monkeypatch)
+    rename = os.rename
+    leasefilename = vsanmetrics.getFleetLeaseFilename(a, args)
+
+    # c moves the stale lease away first, the rename of a fails
+    def racingRename(source, destination):
+        rename(leasefilename, leasefilename + '.c')
+        rename(source, destination)
+
+    monkeypatch.setattr(os, 'rename', racingRename)
+
+    assert vsanmetrics.acquireFleetLease(a, args) is None
+    assert os.listdir(os.path.join(str(tmp_path), 'leases')) == [os.path.basename(leasefilename) + '.c']
+
+
+def test_lease_created_by_another_instance(tmp_path, monkeypatch):
+    a, c, args = raceInstances(tmp_path, monkeypatch)
+    leasefilename = vsanmetrics.getFleetLeaseFilename(a, args)
+    osOpen = os.open
+
+    os.remove(leasefilename)
+
+    # c creates the missing lease between the read and the creation of a
+    def racingOpen(filename, flags, *others):
+        monkeypatch.setattr(os, 'open', osOpen)
+        assert vsanmetrics.acquireFleetLease(c, args) is True
+        return osOpen(filename, flags, *others)
+
+    monkeypatch.setattr(os, 'open', racingOpen)
+
+    assert vsanmetrics.acquireFleetLease(a, args) is None
+    assert getLeaseHolder(a, args) == 'c'
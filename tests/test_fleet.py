@@ -0,0 +1,308 @@
+import types
+
+import pytest
+
+import vsanmetrics
+
+
+# Inventory of a fake vCenter, counting the views created and destroyed and the retrievals
+class FakeContent(object):
+
+    def __init__(self, clusters):
+        self.clusters = clusters
+        self.calls = {'views': 0, 'destroyed': 0, 'retrievals': 0}
+        self.rootFolder = 'group-d1'
+        self.viewManager = types.SimpleNamespace(CreateContainerView=self.createContainerView)
+        self.propertyCollector = types.SimpleNamespace(RetrieveContents=self.retrieveContents)
+
+    def createContainerView(self, container, viewType, recursive):
+        self.calls['views'] += 1
+
+        return vsanmetrics.vim.view.ContainerView('session[1]view-%i' % self.calls['views'], self)
+
+    # The views are bound to the content, it receives their calls as their stub
+    def InvokeMethod(self, mo, info, args):
+        if info.name == 'Destroy':
+            self.calls['destroyed'] += 1
+
+    def retrieveContents(self, filterSpecs):
+        self.calls['retrievals'] += 1
+
+        return [types.SimpleNamespace(obj=moId, propSet=[types.SimpleNamespace(name='name', val=name)])
+                for moId, name in self.clusters.items()]
+
+
+@pytest.fixture
+def vsanModules():
+    pytest.importorskip('pyVmomi')
+
+    try:
+        vsanmetrics.loadVsanModules()
+    except ImportError:
+        # The lookup of the clusters only needs pyVmomi
+        pass
+
+
+def test_clusters_are_looked_up_once_per_session(vsanModules):
+    content = FakeContent({'domain-c%i' % index: 'CL%i' % index for index in range(50)})
+    clusters = {}
+
+    for index in range(50):
+        assert vsanmetrics.getClusterInstance('CL%i' % index, content, clusters) == 'domain-c%i' % index
+
+    assert content.calls == {'views': 1, 'destroyed': 1, 'retrievals': 1}
+
+
+def test_unknown_cluster_is_looked_up_again(vsanModules):
+    content = FakeContent({'domain-c1': 'CL1'})
+    clusters = {}
+
+    assert vsanmetrics.getClusterInstance('CL1', content, clusters) == 'domain-c1'
+
+    content.clusters['domain-c2'] = 'CL2'
+
+    assert vsanmetrics.getClusterInstance('CL2', content, clusters) == 'domain-c2'
+    assert vsanmetrics.getClusterInstance('CL3', content, clusters) is None
+    assert content.calls == {'views': 3, 'destroyed': 3, 'retrievals': 3}
+
+
+def test_duplicate_cluster_names(vsanModules):
+    content = FakeContent({'domain-c1': 'CL1', 'domain-c2': 'CL1'})
+
+    with pytest.raises(Exception, match='more than one cluster'):
+        vsanmetrics.getClusterInstance('CL1', content)
+
+
+def test_view_is_destroyed_when_the_retrieval_fails(vsanModules):
+    content = FakeContent({})
+
+    def fail(filterSpecs):
+        raise OSError('connection reset')
+
+    content.propertyCollector.RetrieveContents = fail
+
+    with pytest.raises(OSError):
+        vsanmetrics.getClusterInstance('CL1', content)
+
+    assert content.calls['destroyed'] == 1
+
+
+# vCenters of a fleet, their logins and collections are recorded
+class FakeVcenters(object):
+
+    def __init__(self, monkeypatch, duration=0.05, results=None):
+        self.duration = duration
+        self.results = results or {}
+        self.logins = []
+        self.disconnections = []
+        self.collections = []
+        self.active = {}
+        self.maxActive = {}
+        self.lock = vsanmetrics.threading.Lock()
+        self.start = vsanmetrics.time.time()
+        self.exitHandlers = []
+
+        monkeypatch.setattr(vsanmetrics, 'loginvCenter', self.login)
+        monkeypatch.setattr(vsanmetrics, 'collectCluster', self.collect)
+        monkeypatch.setattr(vsanmetrics, 'isSessionValid', lambda si: si['valid'])
+        monkeypatch.setattr(vsanmetrics, 'disconnectvCenter', self.disconnections.append)
+        monkeypatch.setattr(vsanmetrics.atexit, 'register', lambda function, *args: self.exitHandlers.append((function, args)))
+
+    def login(self, args, disconnectAtExit=True):
+        assert not disconnectAtExit
+
+        si = {'vcenter': args.vcenter, 'valid': True, 'id': len(self.logins)}
+        self.logins.append(si)
+
+        return si
+
+    def collect(self, args, si, dedup, clusters):
+        assert si['vcenter'] == args.vcenter
+
+        with self.lock:
+            for key in (args.vcenter, 'fleet'):
+                self.active[key] = self.active.get(key, 0) + 1
+                self.maxActive[key] = max(self.maxActive.get(key, 0), self.active[key])
+
+            self.collections.append((args.vcenter, args.clusterName, si['id'], id(clusters), vsanmetrics.time.time() - self.start))
+
+        vsanmetrics.time.sleep(self.duration)
+
+        with self.lock:
+            for key in (args.vcenter, 'fleet'):
+                self.active[key] -= 1
+
+        return self.results.get(args.clusterName, True)
+
+
+def writeFleetConfig(tmp_path, content):
+    filename = tmp_path / 'fleet.ini'
+    filename.write_text(content)
+
+    return str(filename)
+
+
+def runFleetEngine(fleet):
+    vsanmetrics.loadFleetModules()
+    vsanmetrics.asyncio.run(vsanmetrics.runFleetEngine(fleet))
+
+
+def test_fleet_schedule_is_round_robin(tmp_path):
+    fleet = vsanmetrics.readFleetConfig(writeFleetConfig(tmp_path, """
+[fleet]
+options = --health
+[vc1]
+user = u
+password = p
+clusters = A, B, C
+[vc2]
+user = u
+password = p
+clusters = D
+"""))
+
+    schedule = [(args.vcenter, args.clusterName) for args in vsanmetrics.getFleetSchedule(fleet)]
+
+    assert schedule == [('vc1', 'A'), ('vc2', 'D'), ('vc1', 'B'), ('vc1', 'C')]
+
+
+def test_fleet_semaphores_and_shared_sessions(tmp_path, monkeypatch):
+    vcenters = FakeVcenters(monkeypatch)
+
+    fleet = vsanmetrics.readFleetConfig(writeFleetConfig(tmp_path, """
+[fleet]
+concurrency = 3
+vcenterconcurrency = 2
+once = yes
+options = --health
+[vc1]
+user = u
+password = p
+clusters = A, B, C, D, E
+[vc2]
+user = u
+password = p
+clusters = F, G, H
+concurrency = 1
+"""))
+
+    runFleetEngine(fleet)
+
+    assert sorted(cluster for _, cluster, _, _, _ in vcenters.collections) == list('ABCDEFGH')
+    assert vcenters.maxActive == {'vc1': 2, 'vc2': 1, 'fleet': 3}
+
+    # One session per vCenter, shared by its clusters with the clusters found with it
+    assert sorted(si['vcenter'] for si in vcenters.logins) == ['vc1', 'vc2']
+    assert len(set((vcenter, si, clusters) for vcenter, _, si, clusters, _ in vcenters.collections)) == 2
+
+    # The sessions are disconnected at exit, once per vCenter
+    assert [function for function, _ in vcenters.exitHandlers] == [vsanmetrics.closeFleetSession] * 2
+
+
+def test_busy_vcenter_does_not_hold_fleet_slots(tmp_path, monkeypatch):
+    vcenters = FakeVcenters(monkeypatch, duration=0.1)
+
+    fleet = vsanmetrics.readFleetConfig(writeFleetConfig(tmp_path, """
+[fleet]
+concurrency = 2
+once = yes
+options = --health
+[vc1]
+user = u
+password = p
+clusters = A, B, C, D
+concurrency = 1
+[vc2]
+user = u
+password = p
+clusters = E
+"""))
+
+    runFleetEngine(fleet)
+
+    starts = dict((cluster, start) for _, cluster, _, _, start in vcenters.collections)
+
+    # The clusters of vc1 wait for their vCenter, the cluster of vc2 gets the free slot of the fleet at once
+    assert starts['E'] < 0.08
+    assert starts['D'] > 0.25
+
+
+def test_session_is_reused_until_it_expires(tmp_path, monkeypatch):
+    vcenters = FakeVcenters(monkeypatch, duration=0, results={'B': False})
+
+    fleet = vsanmetrics.readFleetConfig(writeFleetConfig(tmp_path, """
+[fleet]
+options = --health
+[vc1]
+user = u
+password = p
+clusters = A, B
+"""))
+
+    clusterA, clusterB = fleet['clusters']
+    session = {'lock': vsanmetrics.threading.Lock(), 'si': None, 'clusters': {}}
+    state = {'dedup': None}
+
+    vsanmetrics.runFleetCollection(clusterA, session, state)
+    vsanmetrics.runFleetCollection(clusterA, session, state)
+    session['clusters']['A'] = ['domain-c1']
+
+    # A failure with a valid session keeps it, the clusters are looked up again
+    vsanmetrics.runFleetCollection(clusterB, session, state)
+
+    assert len(vcenters.logins) == 1
+    assert session['si'] is vcenters.logins[0]
+    assert session['clusters'] == {}
+
+    # A failure with an expired session disconnects it, the next collection logs in again
+    vcenters.logins[0]['valid'] = False
+    vsanmetrics.runFleetCollection(clusterB, session, state)
+
+    assert vcenters.disconnections == [vcenters.logins[0]]
+    assert session['si'] is None
+
+    vsanmetrics.runFleetCollection(clusterA, session, state)
+
+    assert len(vcenters.logins) == 2
+    assert [si for _, _, si, _, _ in vcenters.collections] == [0, 0, 0, 0, 1]
+
+
+def test_invalid_cluster_options_name_the_cluster(tmp_path):
+    filename = writeFleetConfig(tmp_path, """
+[fleet]
+options = --health
+[vc1]
+user = u
+password = p
+clusters = A
+[vc2]
+user = u
+password = p
+clusters = B
+options = --capacity --rollup vscsi=vm
+""")
+
+    with pytest.raises(Exception, match='cluster B of vCenter vc2'):
+        vsanmetrics.readFleetConfig(filename)
+
+    with open(filename) as fileObject:
+        content = fileObject.read()
+
+    filename = writeFleetConfig(tmp_path, content.replace('--rollup vscsi=vm', '--unknown'))
+
+    with pytest.raises(Exception, match='cluster B of vCenter vc2'):
+        vsanmetrics.readFleetConfig(filename)
+
+
+def test_invalid_fleet_exits_with_an_error(tmp_path, capsys):
+    filename = writeFleetConfig(tmp_path, """
+[fleet]
+options = --capacity --archive-compact 1
+[vc1]
+user = u
+password = p
+clusters = A
+""")
+
+    assert vsanmetrics.runFleet(filename) == 1
+    assert 'cluster A of vCenter vc1' in capsys.readouterr().out
@@ -0,0 +1,241 @@
+import multiprocessing
+import os
+import socket
+import time
+import types
+
+import pytest
+
+import vsanmetrics
+
+pyVmomi = pytest.importorskip('pyVmomi')
+
+
+@pytest.fixture
+def vsanModules():
+    try:
+        vsanmetrics.loadVsanModules()
+    except ImportError:
+        # Without the vSAN SDK (vsanapiutils, vsanmgmtObjects), pyVmomi is loaded and the stubs can still be built
+        pass
+
+
+# The performance manager and the faults of the vSAN API are registered by the vSAN SDK
+@pytest.fixture
+def vsanSdk(vsanModules):
+    if vsanmetrics.vsanmgmtObjects is None:
+        pytest.skip('the vSAN SDK is needed for the types of the vSAN API')
+
+
+# A local endpoint accepting connections and never answering
+@pytest.fixture
+def silentEndpoint():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+
+    yield server.getsockname()[1]
+
+    server.close()
+
+
+@pytest.fixture
+def noBackoff(monkeypatch):
+    monkeypatch.setattr(vsanmetrics.random, 'uniform', lambda low, high: 0)
+
+
+def test_vsan_stub_times_out(vsanModules, silentEndpoint):
+    version = pyVmomi.VmomiSupport.newestVersions.Get('vim')
+    stub = vsanmetrics.getVsanStub('127.0.0.1', silentEndpoint, 'vmware_soap_session="x"', version, 1)
+
+    assert stub.cookie == 'vmware_soap_session="x"'
+
+    start = time.time()
+
+    with pytest.raises(OSError):
+        pyVmomi.vim.ServiceInstance('ServiceInstance', stub).CurrentTime()
+
+    assert time.time() - start < 5
+
+
+def test_perf_system_times_out(vsanSdk, silentEndpoint):
+    perfSystems = {}
+    version = pyVmomi.VmomiSupport.newestVersions.Get('vim')
+    perfSystem = vsanmetrics.getPerfSystem(perfSystems, '127.0.0.1', silentEndpoint, 'x', version, 0.5)
+
+    # Timeouts are rounded up, the manager is reused for the same timeout
+    assert vsanmetrics.getPerfSystem(perfSystems, '127.0.0.1', silentEndpoint, 'x', version, 1) is perfSystem
+
+    start = time.time()
+
+    with pytest.raises(OSError):
+        perfSystem.VsanPerfQueryPerf(querySpecs=[], cluster=None)
+
+    assert time.time() - start < 5
+
+    vsanmetrics.closePerfSystems(perfSystems)
+    assert perfSystems == {}
+
+
+def test_retry_query_records_successful_attempt(vsanSdk, noBackoff):
+    attempts = []
+
+    def query():
+        attempts.append(time.time())
+
+        if len(attempts) == 1:
+            time.sleep(0.2)
+            raise socket.timeout('timed out')
+
+        return 'result'
+
+    result, duration = vsanmetrics.retryQuery(query, 2)
+
+    assert result == 'result'
+    assert len(attempts) == 2
+    assert duration < 0.1
+
+
+def test_retry_query_gives_up(vsanSdk, noBackoff):
+    attempts = []
+
+    def query():
+        attempts.append(time.time())
+        raise socket.timeout('timed out')
+
+    with pytest.raises(OSError):
+        vsanmetrics.retryQuery(query, 2)
+
+    assert len(attempts) == 3
+
+
+def test_retry_query_does_not_retry_invalid_queries(vsanSdk, noBackoff):
+    attempts = []
+
+    def query():
+        attempts.append(time.time())
+        raise pyVmomi.vmodl.fault.InvalidArgument()
+
+    with pytest.raises(pyVmomi.vmodl.fault.InvalidArgument):
+        vsanmetrics.retryQuery(query, 2)
+
+    assert len(attempts) == 1
+
+
+# Process pool running the shards at once, against the entities known by a fake vSAN
+class FakePool(object):
+
+    def __init__(self, known):
+        self.known = known
+        self.shards = []
+
+    def apply_async(self, function, args):
+        entitieName, entityRefIds, labels = args[:3]
+        self.shards.append(list(entityRefIds))
+
+        metrics = [types.SimpleNamespace(entityRefId=entityRefId, sampleInfo='2018-05-04 19:00:00',
+                                         value=[types.SimpleNamespace(metricId=types.SimpleNamespace(label=label), values='1.0') for label in labels])
+                   for entityRefId in entityRefIds if entityRefId in self.known]
+
+        batch = vsanmetrics.buildPerfBatch(entitieName, metrics, labels, {}, {}, {})
+
+        return types.SimpleNamespace(get=lambda timeout: (batch, 0.1))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+# The entities of virtual-disk are known by a fake vSAN, the queries of all of them are recorded
+class FakeVsanPerf(object):
+
+    def __init__(self, tmp_path, monkeypatch, vmDisks):
+        self.vmDisks = vmDisks
+        self.known = []
+        self.queries = []
+        self.outputs = []
+        self.pools = []
+
+        self.args = types.SimpleNamespace(cachefolder=str(tmp_path), vcenter='vc1', port=443, clusterName='CL1', cacheTTL=60,
+                                          skipentitytypes=None, processes=2, shardentitytypes='virtual-disk', shardsize=2,
+                                          labels={}, entities={}, rollup={}, perfretries=0, perftimeout=60, perfcooldown=30)
+
+        monkeypatch.setattr(vsanmetrics, 'getEntityTypes', lambda cachefolder, content, vcMos: [{'name': 'virtual-disk', 'labels': ['iops']}])
+        monkeypatch.setattr(vsanmetrics, 'getPerfSystem', lambda *args: None)
+        monkeypatch.setattr(vsanmetrics, 'queryPerf', self.queryPerf)
+        monkeypatch.setattr(vsanmetrics, 'outputPerfBatch', lambda args, batch, *others: self.outputs.extend(batch['tags']))
+        monkeypatch.setattr(multiprocessing, 'get_context', lambda method: types.SimpleNamespace(Pool=self.getPool))
+
+    def getPool(self, processes, initializer, initargs):
+        self.pools.append(FakePool(self.known))
+
+        return self.pools[-1]
+
+    def queryPerf(self, perfSystem, cluster_obj, entityRefIds, labels, startTime, endTime):
+        self.queries.append(entityRefIds)
+
+        return [types.SimpleNamespace(entityRefId=entityRefId, sampleInfo='2018-05-04 19:00:00',
+                                      value=[types.SimpleNamespace(metricId=types.SimpleNamespace(label='iops'), values='1.0')])
+                for entityRefId in self.known]
+
+    def run(self):
+        self.queries, self.outputs, self.pools = [], [], []
+
+        stub = types.SimpleNamespace(_stub=types.SimpleNamespace(cookie='x', version='vim.version.version1'))
+
+        vsanmetrics.getPerformance(self.args, {}, stub, None, types.SimpleNamespace(_moId='domain-c1'), {'vsan-performance-manager': stub},
+                                   {}, {}, {}, {}, self.vmDisks)
+
+        return [shard for pool in self.pools for shard in pool.shards]
+
+
+def test_vm_disks_shards_come_from_the_inventory(tmp_path, monkeypatch, vsanModules):
+    vmDisks = {'vm-1': [{'objects': [], 'key': 2000, 'node': 'scsi0:0'}, {'objects': [], 'key': 2001, 'node': 'scsi0:1'}],
+               'vm-2': [{'objects': [], 'key': 2000, 'node': None}]}
+
+    assert vsanmetrics.getVMDisksEntityRefIds('vscsi', vmDisks) == ['vscsi:vm-1|scsi0:0', 'vscsi:vm-1|scsi0:1']
+
+    perf = FakeVsanPerf(tmp_path, monkeypatch, vmDisks)
+    derived = vsanmetrics.getVMDisksEntityRefIds('virtual-disk', vmDisks)
+    perf.known[:] = derived
+
+    # Sharded from the devices of the VMs, virtual-disk is never queried all at once
+    assert perf.run() == [derived[:2], derived[2:]]
+    assert perf.queries == []
+    assert len(perf.outputs) == 3
+
+    # vSAN knows none of the derived entities: they are listed by vSAN, as long as it doesn't know some of them
+    perf.known[:] = ['virtual-disk:vm-1/scsi0:0']
+
+    assert perf.run() == [derived[:2], derived[2:]]
+    assert perf.outputs == []
+
+    assert perf.run() == []
+    assert perf.queries == [['virtual-disk:*']]
+
+    assert perf.run() == [['virtual-disk:vm-1/scsi0:0']]
+
+    # Once vSAN lists some of the derived entities, they are used again
+    os.remove(vsanmetrics.getCacheFilename(perf.args, 'entities'))
+    perf.known[:] = derived
+
+    perf.run()
+    assert perf.queries == [['virtual-disk:*']]
+    assert perf.run() == [derived[:2], derived[2:]]
+
+
+def test_vm_disks_are_only_needed_for_their_shards():
+    args = types.SimpleNamespace(performance=True, processes=4, shardentitytypes='virtual-disk,vscsi,virtual-machine',
+                                 skipentitytypes=None, entities={})
+
+    assert vsanmetrics.isVMDisksSharded(args)
+
+    args.skipentitytypes = 'vscsi'
+    args.entities = {'virtual-disk': ['vm01']}
+    assert not vsanmetrics.isVMDisksSharded(args)
+
+    args.entities = {}
+    args.processes = 1
+    assert not vsanmetrics.isVMDisksSharded(args)
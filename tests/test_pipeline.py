@@ -0,0 +1,56 @@
+import hashlib
+from array import array
+
+import benchvsanmetrics
+import vsanmetrics
+
+
+def getBatch(nbRows):
+    batch = {}
+    batch['measurement'] = 'virtual-machine'
+    batch['labels'] = ['iopsRead', 'iopsWrite']
+    batch['tagKeys'] = ('uuid', 'vmname')
+    batch['timestamps'] = array('q', [1525460700000000000] * nbRows)
+    batch['tags'] = [('uuid%i' % row, 'vm%i' % row) for row in range(nbRows)]
+    batch['values'] = array('d')
+
+    for row in range(nbRows):
+        # Every third entity has no value, it is not written
+        batch['values'].extend([float('nan'), float('nan')] if row % 3 == 0 else [float(row), float('nan')])
+
+    return batch
+
+
+def test_batch_is_written_by_bounded_chunks():
+    tagsbase = {'vcenter': 'vc1', 'cluster': 'CL'}
+    chunks = list(vsanmetrics.formatPerfBatch(getBatch(100), tagsbase, 10))
+
+    assert all(chunk.count('\n') == 10 for chunk in chunks[:-1])
+    assert 0 < chunks[-1].count('\n') <= 10
+
+    lines = ''.join(chunks).splitlines()
+
+    assert len(lines) == 66
+    assert lines[0] == 'virtual-machine,uuid=uuid1,vmname=vm1,vcenter=vc1,cluster=CL iopsRead=1.0 1525460700000000000 '
+    assert ''.join(chunks) == ''.join(vsanmetrics.formatPerfBatch(getBatch(100), tagsbase, 1000))
+
+
+def test_empty_batch_writes_nothing():
+    assert list(vsanmetrics.formatPerfBatch(getBatch(0), {'vcenter': 'vc1'})) == []
+
+
+def test_benchmark_pipelines_have_the_same_output():
+    tagsbase = {'vcenter': 'vc1', 'cluster': 'CL'}
+
+    for nbTypes in (3, 1):
+        labels, vms, metricsByType = benchvsanmetrics.getMetrics(250, nbTypes, 4, 2)
+
+        for chunkLines in (vsanmetrics.perfOutputLines, 7, None):
+            outputs = []
+
+            for pipeline in (benchvsanmetrics.runLegacy, benchvsanmetrics.runBatch):
+                output = hashlib.sha1()
+                pipeline(metricsByType, labels, tagsbase, vms, output, chunkLines)
+                outputs.append(output.hexdigest())
+
+            assert outputs[0] == outputs[1]
@@ -0,0 +1,24 @@
+import benchvsanmetrics
+
+
+def test_import_does_not_load_lazy_modules():
+    assert benchvsanmetrics.getEagerModules() == []
+
+
+def test_eager_modules_are_detected(monkeypatch):
+    monkeypatch.setattr(benchvsanmetrics, 'lazyModules', ('json', 'asyncio'))
+
+    assert benchvsanmetrics.getEagerModules() == ['json']
+
+
+def test_start_is_within_the_default_budgets(capsys):
+    args = benchvsanmetrics.get_args(['--startup', '--runs', '3'])
+
+    assert benchvsanmetrics.runStartup(args) == 0, capsys.readouterr().out
+
+
+def test_start_over_its_budget_fails(capsys):
+    args = benchvsanmetrics.get_args(['--startup', '--runs', '1', '--import-budget', '0.001'])
+
+    assert benchvsanmetrics.runStartup(args) == 1
+    assert 'import vsanmetrics is over its budget' in capsys.readouterr().out
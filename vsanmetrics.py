@@ -2,30 +2,67 @@
 
 # Erwan Quelin - erwan.quelin@gmail.com
 
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import VmomiSupport, SoapStubAdapter, vim, vmodl
-
 import threading
 
+import configparser
+import shlex
+import bisect
+import hashlib
+import socket
+
 import argparse
 import atexit
 import getpass
 from datetime import datetime, timedelta
 import time
-import ssl
 import pickle
 import os
+import sys
+import random
+import math
+import json
+import mmap
+import struct
+import zlib
+from array import array
+
+# pyVmomi, the vSAN types and ssl are only loaded when a vCenter is queried, by loadVsanModules
+SmartConnect = Disconnect = VmomiSupport = SoapStubAdapter = vim = vmodl = None
+ssl = vsanapiutils = vsanmgmtObjects = None
+
+# asyncio is only loaded by the fleet mode, by loadFleetModules
+asyncio = None
+
+
+# Load the modules of the vSAN API
+# Registering the vSAN types is the largest part of the start of the script, --help and the side scripts don't need them
+def loadVsanModules():
+    global SmartConnect, Disconnect, VmomiSupport, SoapStubAdapter, vim, vmodl, ssl, vsanapiutils, vsanmgmtObjects
+
+    if vsanmgmtObjects is not None:
+        return
 
-import vsanapiutils
-import vsanmgmtObjects
+    import ssl
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi import VmomiSupport, SoapStubAdapter, vim, vmodl
+    import vsanapiutils
+    import vsanmgmtObjects
 
 
-def get_args():
+# Load the event loop of the fleet mode, the other helpers of the fleet are imported at start
+def loadFleetModules():
+    global asyncio
+
+    import asyncio
+
+
+# Parser of the options of a collection
+def getParser():
     parser = argparse.ArgumentParser(
         description='Export vSAN cluster performance and storage usage statistics to InfluxDB line protocol')
 
     parser.add_argument('-s', '--vcenter',
-                        required=True,
+                        required=False,
                         action='store',
                         help='Remote vcenter to connect to')
 
@@ -36,7 +73,7 @@ def get_args():
                         help='Port to connect on')
 
     parser.add_argument('-u', '--user',
-                        required=True,
+                        required=False,
                         action='store',
                         help='User name to use when connecting to vcenter')
 
@@ -47,9 +84,14 @@ def get_args():
 
     parser.add_argument('-c', '--cluster_name',
                         dest='clusterName',
-                        required=True,
+                        required=False,
                         help='Cluster Name')
 
+    parser.add_argument('--fleet',
+                        required=False,
+                        action='store',
+                        help='Configuration file of the vCenters and clusters to collect from one process')
+
     parser.add_argument("--performance",
                         help="Output performance metrics",
                         action="store_true")
@@ -58,6 +100,27 @@ def get_args():
                         help="Output storage usage metrics",
                         action="store_true")
 
+    parser.add_argument("--capacity-objects",
+                        dest='capacityObjects',
+                        help="Output storage usage metrics of each vSAN object and VM",
+                        action="store_true")
+
+    parser.add_argument('--capacity-pagesize',
+                        dest='capacityPageSize',
+                        type=int,
+                        default=500,
+                        required=False,
+                        action='store',
+                        help='Number of vSAN objects queried by each storage usage query')
+
+    parser.add_argument('--capacity-threads',
+                        dest='capacityThreads',
+                        type=int,
+                        default=4,
+                        required=False,
+                        action='store',
+                        help='Number of storage usage queries run concurrently')
+
     parser.add_argument("--health",
                         help="Output cluster health status",
                         action="store_true")
@@ -67,6 +130,95 @@ def get_args():
                         action='store',
                         help='List of entity types to skip. Separated by a comma')
 
+    parser.add_argument("--dedup",
+                        help="Output capacity and health series only when their values change or when the heartbeat is over",
+                        action="store_true")
+
+    parser.add_argument('--heartbeat',
+                        type=int,
+                        default=60,
+                        required=False,
+                        action='store',
+                        help='Interval (minutes) after which an unchanged series is output again when --dedup is used')
+
+    parser.add_argument('--archive',
+                        required=False,
+                        action='store',
+                        help='Folder of the local archive where performance, capacity and health results are also stored')
+
+    parser.add_argument('--archive-compact',
+                        dest='archiveCompact',
+                        type=int,
+                        default=12,
+                        action='store',
+                        help='Number of chunks of a measurement and day after which they are merged in one chunk of the archive')
+
+    parser.add_argument('--labels',
+                        required=False,
+                        action='append',
+                        help='Labels to query for an entity type, ex: virtual-machine=iopsRead,iopsWrite. Can be used multiple times')
+
+    parser.add_argument('--entities',
+                        required=False,
+                        action='append',
+                        help='Entities to query for an entity type (hostname, disk group, disk or VM, by name or uuid), ex: virtual-machine=vm01,vm02. Can be used multiple times')
+
+    parser.add_argument('--rollup',
+                        required=False,
+                        action='append',
+                        help='Levels to aggregate an entity type at (host, diskgroup, vm, cluster), ex: capacity-disk=host,cluster. Can be used multiple times')
+
+    parser.add_argument('--rollupfunctions',
+                        default='sum,mean,max,p95',
+                        required=False,
+                        action='store',
+                        help='Aggregation functions of the rollups (sum, mean, min, max, count, p50, p95...). Separated by a comma')
+
+    parser.add_argument("--rolluponly",
+                        help="Output only the rollups of the aggregated entity types, not their raw series",
+                        action="store_true")
+
+    parser.add_argument('--perftimeout',
+                        type=int,
+                        default=120,
+                        required=False,
+                        action='store',
+                        help='Maximum timeout (seconds) of the query of an entity type, adapted to its previous durations')
+
+    parser.add_argument('--perfretries',
+                        type=int,
+                        default=2,
+                        required=False,
+                        action='store',
+                        help='Number of retries of the query of an entity type after a transient fault')
+
+    parser.add_argument('--perfcooldown',
+                        type=int,
+                        default=30,
+                        required=False,
+                        action='store',
+                        help='Duration (minutes) during which an entity type failing on 3 consecutive runs is skipped')
+
+    parser.add_argument('--processes',
+                        type=int,
+                        default=1,
+                        required=False,
+                        action='store',
+                        help='Number of processes used to query and parse the sharded entity types')
+
+    parser.add_argument('--shardentitytypes',
+                        default='virtual-disk,vscsi,virtual-machine',
+                        required=False,
+                        action='store',
+                        help='List of entity types to shard when more than one process is used. Separated by a comma')
+
+    parser.add_argument('--shardsize',
+                        type=int,
+                        default=200,
+                        required=False,
+                        action='store',
+                        help='Number of entities queried by each shard')
+
     parser.add_argument('--cachefolder',
                         default='.',
                         required=False,
@@ -80,25 +232,106 @@ def get_args():
                         action='store',
                         help='TTL of the object inventory cache')
 
-    args = parser.parse_args()
+    parser.add_argument('--versionCacheTTL',
+                        type=int,
+                        default=1440,
+                        required=False,
+                        action='store',
+                        help='TTL of the vSAN API version cache')
+
+    return parser
+
+
+def get_args(argv=None):
+    args = getParser().parse_args(argv)
+
+    # The vCenters, clusters and options are read from the configuration file
+    if args.fleet:
+        return args
+
+    try:
+        checkArgs(args)
+    except ValueError as e:
+        print(str(e))
+        exit()
 
     if not args.password:
         args.password = getpass.getpass(
             prompt='Enter password for host %s and user %s: ' %
                    (args.vcenter, args.user))
 
+    return args
+
+
+# Check the options of a collection, raise ValueError if they are invalid
+def checkArgs(args):
+
+    if not args.vcenter or not args.user or not args.clusterName:
+        raise ValueError('Please provide the parameters --vcenter, --user and --cluster_name, or a configuration file with --fleet')
+
     if not args.performance and args.skipentitytypes:
-        print("You can't skip a performance entity type if you don't provide the --performance tag")
-        exit()
+        raise ValueError("You can't skip a performance entity type if you don't provide the --performance tag")
+
+    if not args.capacity and args.capacityObjects:
+        raise ValueError("You can't output storage usage of vSAN objects if you don't provide the --capacity tag")
+
+    if not args.performance and (args.labels or args.entities):
+        raise ValueError("You can't filter labels or entities if you don't provide the --performance tag")
+
+    if not args.performance and args.rollup:
+        raise ValueError("You can't aggregate entity types if you don't provide the --performance tag")
 
     if not args.performance and not args.capacity and not args.health:
-        print('Please provide tag(s) --performance and/or --capacity and/or --health to specify what type of data you want to collect')
-        exit()
+        raise ValueError('Please provide tag(s) --performance and/or --capacity and/or --health to specify what type of data you want to collect')
 
-    return args
+    args.labels = parseEntityTypeFilters(args.labels)
+    args.entities = parseEntityTypeFilters(args.entities)
+    args.rollup = parseEntityTypeFilters(args.rollup)
+
+    for entityType in args.entities:
+        if entityType not in entityFilterTypes:
+            raise ValueError("Entities can't be filtered for entity type %s, only for : %s" % (entityType, ', '.join(entityFilterTypes)))
 
+    if args.archiveCompact < 2:
+        raise ValueError("The number of chunks merged in the archive should be at least 2 : " + str(args.archiveCompact))
 
-def connectvCenter(args):
+    args.rollupfunctions = args.rollupfunctions.split(',')
+
+    for entityType, levels in args.rollup.items():
+        for level in levels:
+            if level not in ('host', 'diskgroup', 'vm', 'cluster'):
+                raise ValueError("Rollup levels should be host, diskgroup, vm or cluster : " + level)
+
+            # The entities of an unsupported level have no group, the rollup would be empty
+            if level != 'cluster' and level not in rollupLevelTypes.get(entityType, ()):
+                raise ValueError("Entity type %s can't be aggregated at level %s, only at : %s" % (entityType, level, ', '.join(rollupLevelTypes.get(entityType, ()) + ('cluster',))))
+
+    for function in args.rollupfunctions:
+        if function not in ('sum', 'mean', 'min', 'max', 'count') and not (function[:1] == 'p' and function[1:].isdigit() and int(function[1:]) <= 100):
+            raise ValueError("Rollup functions should be sum, mean, min, max, count or a percentile (ex: p95) : " + function)
+
+
+# Convert a list of 'entitytype=item1,item2' strings to a dictionnary of lists indexed by entity type
+def parseEntityTypeFilters(values):
+
+    filters = {}
+
+    for value in values or []:
+        entityType, separator, items = value.partition('=')
+
+        if not separator or not entityType or not items:
+            raise ValueError("Filters should be provided as entitytype=item1,item2 : " + value)
+
+        filters.setdefault(entityType, []).extend(items.split(','))
+
+    return filters
+
+
+# Connect to vCenter
+# A long running caller disconnecting its sessions itself doesn't register the disconnection at exit
+def loginvCenter(args, disconnectAtExit=True):
+
+    loadVsanModules()
 
     # Don't check for valid certificate
     context = ssl._create_unverified_context()
@@ -119,22 +352,72 @@ def connectvCenter(args):
     except Exception as e:
         raise Exception("Caught exception : " + str(e))
 
+    # Disconnect to vcenter at the end
+    if disconnectAtExit:
+        atexit.register(Disconnect, si)
+
+    return si
+
+
+# Disconnect a session which may have already expired
+def disconnectvCenter(si):
+
+    try:
+        Disconnect(si)
+    except (vmodl.MethodFault, OSError) as e:
+        print("Caught exception while disconnecting : " + str(e))
+
+
+# Check that a session is still authenticated
+def isSessionValid(si):
+
+    try:
+        return si.content.sessionManager.currentSession is not None
+    except (vmodl.MethodFault, OSError):
+        return False
+
+
+# An existing session can be provided, to collect several clusters of the same vCenter
+# The clusters already found with this session can be provided too
+def connectvCenter(args, si=None, clusters=None):
+
+    loadVsanModules()
+
+    context = ssl._create_unverified_context()
+
+    if not si:
+        si = loginvCenter(args)
+
     # Get content informations
     content = si.RetrieveContent()
 
     # Get Info about cluster
-    cluster_obj = getClusterInstance(args.clusterName, content)
+    cluster_obj = getClusterInstance(args.clusterName, content, clusters)
 
     # Exit if the cluster provided in the arguments is not available
     if not cluster_obj:
         raise Exception('Inventory exception: Did not find the required cluster')
 
-    # Disconnect to vcenter at the end
-    atexit.register(Disconnect, si)
+    vcMos = getVsanVcMos(args, si, cluster_obj, context)
+
+    return si, content, cluster_obj, vcMos
+
+
+# Build the vSAN managed objects of the vCenter
+# The vmodl version and the vSAN status of the cluster are stored in a cache file and only probed again when the TTL is over
+def getVsanVcMos(args, si, cluster_obj, context, refresh=False):
+
+    versionfilename = getCacheFilename(args, 'version')
+
+    if not refresh and isFilesExist((versionfilename,)) and not isTTLOver((versionfilename,), args.versionCacheTTL):
+        # vSAN has already been checked as enabled on the cluster when the cache has been written
+        apiVersion = pickelLoadObject(versionfilename)
+
+        return vsanapiutils.GetVsanVcMos(si._stub, context=context, version=apiVersion)
 
     apiVersion = vsanapiutils.GetLatestVmodlVersion(args.vcenter)
     vcMos = vsanapiutils.GetVsanVcMos(si._stub, context=context, version=apiVersion)
-    
+
     vsanClusterConfigSystem = vcMos['vsan-cluster-config-system']
 
     try:
@@ -150,26 +433,71 @@ def connectvCenter(args):
     if not clusterConfig.enabled:
         raise Exception("Configuration exeption: vSAN is not enabled on cluster " + args.clusterName)
 
-    return si, content, cluster_obj, vcMos
+    pickelDumpObject(apiVersion, versionfilename)
 
+    return vcMos
 
-# Get cluster informations
-def getClusterInstance(clusterName, content):
+
+# Get the clusters of the vCenter by name, their names are retrieved in one call
+def getClusterInstances(content):
     container = content.rootFolder
     viewType = [vim.ClusterComputeResource]
     recursive = True
     containerView = content.viewManager.CreateContainerView(container, viewType, recursive)
-    clusters = containerView.view
 
-    nbClusterWithSameName = 0
+    traversalSpec = vmodl.query.PropertyCollector.TraversalSpec(
+        name='viewToCluster',
+        type=vim.view.ContainerView,
+        path='view',
+        skip=False
+    )
+
+    objectSpec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=containerView,
+        skip=True,
+        selectSet=[traversalSpec]
+    )
+
+    propertySpec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.ClusterComputeResource,
+        pathSet=['name']
+    )
+
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[objectSpec],
+        propSet=[propertySpec]
+    )
+
+    clusters = {}
+
+    # The view is kept by the vCenter until it is destroyed or the session ends
+    try:
+        for object in content.propertyCollector.RetrieveContents([filterSpec]):
+            for prop in object.propSet:
+                clusters.setdefault(prop.val, []).append(object.obj)
+    finally:
+        containerView.Destroy()
+
+    return clusters
+
+
+# Get cluster informations
+# With a long running session, the clusters found are kept in clusters and only retrieved again for an unknown name
+def getClusterInstance(clusterName, content, clusters=None):
+
+    if clusters is None:
+        clusters = {}
 
-    for cluster in clusters:
-        if cluster.name == clusterName:
-            nbClusterWithSameName += 1
-            cluster_obj = cluster
+    if clusterName not in clusters:
+        instances = getClusterInstances(content)
+        clusters.clear()
+        clusters.update(instances)
+
+    instances = clusters.get(clusterName, [])
+    nbClusterWithSameName = len(instances)
 
     if nbClusterWithSameName == 1:
-        return cluster_obj
+        return instances[0]
 
     if nbClusterWithSameName > 1:
         raise Exception("There is more than one cluster with the name " + clusterName)
@@ -177,17 +505,18 @@ def getClusterInstance(clusterName, content):
     return None
 
 
-def getInformations(witnessHosts, cluster, si):
+def getInformations(witnessHosts, cluster, si, hosts):
 
     uuid = {}
-    hostnames = {}
     disks = {}
+    diskgroups = {}
 
     # Get Host and disks informations
     for host in cluster.host:
 
-        # Get relationship between host id and hostname
-        hostnames[host.summary.host] = host.summary.config.name
+        # Disks of unreachable hosts can't be queried
+        if not hosts[host._moId]['runtime.connectionState'] == 'connected':
+            continue
 
         # Get all disk (cache and capcity) attached to hosts in the cluster
         diskAll = host.configManager.vsanSystem.QueryDisksForVsan()
@@ -195,26 +524,42 @@ def getInformations(witnessHosts, cluster, si):
         for disk in diskAll:
             if disk.state == 'inUse':
                 uuid[disk.vsanUuid] = disk.disk.canonicalName
-                disks[disk.vsanUuid] = host.summary.config.name
+                disks[disk.vsanUuid] = hosts[host._moId]['name']
+
+        # Get relationship between disks and disk groups, a disk group is identified by its cache disk
+        for diskMapping in host.configManager.vsanSystem.config.storageInfo.diskMapping:
+            diskgroups[diskMapping.ssd.vsanDiskInfo.vsanUuid] = diskMapping.ssd.vsanDiskInfo.vsanUuid
+
+            for disk in diskMapping.nonSsd:
+                diskgroups[disk.vsanDiskInfo.vsanUuid] = diskMapping.ssd.vsanDiskInfo.vsanUuid
 
     for vsanHostConfig in cluster.configurationEx.vsanHostConfig:
-        uuid[vsanHostConfig.clusterInfo.nodeUuid] = hostnames[vsanHostConfig.hostSystem]
+        uuid[vsanHostConfig.clusterInfo.nodeUuid] = hosts[vsanHostConfig.hostSystem._moId]['name']
 
     # Get witness disks informations
 
     for witnessHost in witnessHosts:
         host = (vim.HostSystem(witnessHost.host._moId, si._stub))
 
-        uuid[witnessHost.nodeUuid] = host.name
+        uuid[witnessHost.nodeUuid] = hosts[host._moId]['name']
+
+        if not hosts[host._moId]['runtime.connectionState'] == 'connected':
+            continue
 
         diskWitness = host.configManager.vsanSystem.QueryDisksForVsan()
 
         for disk in diskWitness:
             if disk.state == 'inUse':
                 uuid[disk.vsanUuid] = disk.disk.canonicalName
-                disks[disk.vsanUuid] = host.name
+                disks[disk.vsanUuid] = hosts[host._moId]['name']
+
+        for diskMapping in host.configManager.vsanSystem.config.storageInfo.diskMapping:
+            diskgroups[diskMapping.ssd.vsanDiskInfo.vsanUuid] = diskMapping.ssd.vsanDiskInfo.vsanUuid
+
+            for disk in diskMapping.nonSsd:
+                diskgroups[disk.vsanDiskInfo.vsanUuid] = diskMapping.ssd.vsanDiskInfo.vsanUuid
 
-    return uuid, disks
+    return uuid, disks, diskgroups
 
 
 # Get all VM managed by the hosts in the cluster, return array with name and uuid of the VMs
@@ -233,9 +578,96 @@ def getVMs(cluster):
 
 
 # Output data in the Influx Line protocol format
-def printInfluxLineProtocol(measurement, tags, fields, timestamp):
+# With a dedup state, series whose fields didn't change since their last output are suppressed until the heartbeat
+def printInfluxLineProtocol(measurement, tags, fields, timestamp, dedup=None, archive=None):
+    # The archive keeps all the series, even the ones suppressed by the dedup
+    if archive is not None:
+        archiveRow(archive, measurement, tags, fields, timestamp)
+
+    if dedup is not None and isDuplicate(dedup, measurement, tags, fields, timestamp):
+        return
+
     result = "%s,%s %s %i" % (measurement, arrayToString(tags), arrayToString(fields), timestamp)
-    print(result)
+    writeOutput(result + "\n")
+
+
+# Lock of the output, lines of concurrent collections must not be mixed
+outputLock = threading.Lock()
+
+
+# Write data to the output in one call
+def writeOutput(data, flush=False):
+    with outputLock:
+        sys.stdout.write(data)
+
+        if flush:
+            sys.stdout.flush()
+
+
+# Lock of the dedup states, capacity and health are collected by concurrent threads
+dedupLock = threading.Lock()
+
+
+# Load the dedup state of the cluster, the last output of each series
+def loadDedupState(args):
+
+    dedupfilename = getCacheFilename(args, 'dedup')
+
+    dedup = {'series': {}}
+
+    if isFilesExist((dedupfilename,)):
+        dedup = pickelLoadObject(dedupfilename)
+
+    dedup['heartbeat'] = args.heartbeat * 60 * 1000000000
+    dedup['emitted'] = 0
+    dedup['suppressed'] = 0
+
+    return dedup
+
+
+# Store the dedup state of the cluster, series not output since two heartbeats don't exist anymore
+def saveDedupState(args, dedup):
+
+    dedupfilename = getCacheFilename(args, 'dedup')
+
+    expiration = int(time.time() * 1000000000) - 2 * dedup['heartbeat']
+
+    with dedupLock:
+        for key, (_, lastOutput) in list(dedup['series'].items()):
+            if lastOutput < expiration:
+                del dedup['series'][key]
+
+        pickelDumpObject(dedup, dedupfilename)
+
+
+# Test if a series has already been output with the same fields since the last heartbeat, and record its output otherwise
+def isDuplicate(dedup, measurement, tags, fields, timestamp):
+
+    key = "%s,%s" % (measurement, arrayToString(tags))
+    value = arrayToString(fields)
+
+    with dedupLock:
+        if key in dedup['series']:
+            lastValue, lastOutput = dedup['series'][key]
+
+            if lastValue == value and timestamp - lastOutput < dedup['heartbeat']:
+                dedup['suppressed'] += 1
+                return True
+
+        dedup['series'][key] = (value, timestamp)
+        dedup['emitted'] += 1
+
+    return False
+
+
+# Output the number of series output and suppressed by the dedup
+def getDedupStatistics(tagsbase, dedup):
+
+    fields = {}
+    fields['emitted'] = dedup['emitted']
+    fields['suppressed'] = dedup['suppressed']
+
+    printInfluxLineProtocol('vsanmetrics_dedup', tagsbase, fields, int(time.time() * 1000000000))
 
 
 # Output data in the Influx Line protocol format
@@ -342,6 +774,106 @@ def parseEntityRefId(measurement, entityRefId, uuid, vms, disks):
     return tags
 
 
+# Entity types which can be filtered with --entities, and the items of the inventory they can be filtered by
+entityFilterTypes = {
+    'host-domclient': ('host',),
+    'host-domcompmgr': ('host',),
+    'vsan-host-net': ('host',),
+    'vsan-iscsi-host': ('host',),
+    'cache-disk': ('host', 'diskgroup', 'disk'),
+    'capacity-disk': ('host', 'diskgroup', 'disk'),
+    'disk-group': ('host', 'diskgroup'),
+    'virtual-machine': ('vm',),
+    'virtual-disk': ('vm',),
+    'vscsi': ('vm',),
+}
+
+
+# Convert a VM name or uuid to its uuid, None if the VM is not in the inventory
+def resolveVM(entityId, vms):
+
+    if entityId in vms:
+        return entityId
+
+    for key, val in vms.items():
+        if val == entityId or val == "\\ ".join(entityId.split()):
+            return key
+
+    return None
+
+
+# Convert a hostname or a disk canonical name to its uuid, None if it is not in the inventory
+# Hosts are the items of uuid which are not disks
+def resolveInventoryId(entityId, uuid, disks, isDisk):
+
+    if entityId in uuid and (entityId in disks) == isDisk:
+        return entityId
+
+    for key, val in uuid.items():
+        if val == entityId and (key in disks) == isDisk:
+            return key
+
+    return None
+
+
+# Disks of an entity type: the disk itself for a disk group, its cache disk for cache-disk and its capacity disks for capacity-disk
+def getDisksOfType(entityType, diskUuids, diskgroups):
+
+    if entityType == 'capacity-disk':
+        return [disk for disk in diskUuids if disk in diskgroups and diskgroups[disk] != disk]
+
+    return [disk for disk in diskUuids if diskgroups.get(disk) == disk]
+
+
+# Expand the entities of a filter to the entityRefIds of an entity type
+# A host is expanded to its disks or disk groups, a disk group to its disks, a VM to its virtual disks or vscsi
+# The virtual disks and vscsi of the VMs are known from the last query of all of them (entityRefIds)
+# Return the entityRefIds and the entities which are not in the inventory
+def expandEntityFilter(entityType, entityIds, uuid, disks, vms, diskgroups, entityRefIds):
+
+    kinds = entityFilterTypes[entityType]
+
+    result = []
+    unknown = []
+
+    for entityId in entityIds:
+
+        ids = []
+
+        host = resolveInventoryId(entityId, uuid, disks, False) if 'host' in kinds else None
+        disk = resolveInventoryId(entityId, uuid, disks, True) if 'disk' in kinds or 'diskgroup' in kinds else None
+        vm = resolveVM(entityId, vms) if 'vm' in kinds else None
+
+        if host and entityType in ('cache-disk', 'capacity-disk', 'disk-group'):
+            ids = getDisksOfType(entityType, [key for key, val in disks.items() if val == uuid[host]], diskgroups)
+        elif host:
+            ids = [host]
+        elif disk and disk in diskgroups:
+            # A disk is expanded to the disks of its disk group, except a capacity disk for capacity-disk
+            if entityType == 'capacity-disk' and diskgroups[disk] != disk:
+                ids = [disk]
+            else:
+                ids = getDisksOfType(entityType, [key for key, val in diskgroups.items() if val == diskgroups[disk]], diskgroups)
+        elif vm and entityType == 'virtual-machine':
+            ids = [vm]
+        elif vm:
+            separator = '/' if entityType == 'virtual-disk' else '|'
+            ids = [entityRefId.split(':', 1)[1] for entityRefId in entityRefIds if entityRefId.split(':', 1)[1].startswith(vm + separator)]
+
+        if ids:
+            result.extend('%s:%s' % (entityType, id) for id in ids if '%s:%s' % (entityType, id) not in result)
+        else:
+            unknown.append(entityId)
+
+    return result, unknown
+
+
+# VM of a virtual-disk or vscsi entityRefId
+def getEntityVM(entityRefId):
+
+    return entityRefId.split(':', 1)[1].replace('|', '/').split('/')[0]
+
+
 # Convert array to a string compatible with influxdb line protocol tags or fields
 def arrayToString(data):
     i = 0
@@ -386,7 +918,7 @@ def parseVimVsanDataEfficiencyCapacityState(data):
     return fields
 
 
-def parseCapacity(scope, data, tagsbase, timestamp):
+def parseCapacity(scope, data, tagsbase, timestamp, dedup=None, archive=None):
 
     tags = {}
     fields = {}
@@ -407,10 +939,10 @@ def parseCapacity(scope, data, tagsbase, timestamp):
     else:
         fields = parseVsanObjectSpaceSummary(data)
 
-    printInfluxLineProtocol(measurement, tags, fields, timestamp)
+    printInfluxLineProtocol(measurement, tags, fields, timestamp, dedup, archive)
 
 
-def parseHealth(test, value, tagsbase, timestamp):
+def parseHealth(test, value, tagsbase, timestamp, dedup=None, archive=None):
 
     measurement = 'health_' + test
 
@@ -429,10 +961,10 @@ def parseHealth(test, value, tagsbase, timestamp):
 
     fields['value'] = '\"' + value + '\"'
 
-    printInfluxLineProtocol(measurement, tags, fields, timestamp)
+    printInfluxLineProtocol(measurement, tags, fields, timestamp, dedup, archive)
 
 
-def getCapacity(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms):
+def getCapacity(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms, vmDisks=None, dedup=None, archive=None):
 
     vsanSpaceReportSystem = vcMos['vsan-cluster-space-report-system']
 
@@ -453,14 +985,17 @@ def getCapacity(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms):
 
     timestamp = int(time.time() * 1000000000)
 
-    parseCapacity('global', spaceReport, tagsbase, timestamp)
-    parseCapacity('summary', spaceReport, tagsbase, timestamp)
+    parseCapacity('global', spaceReport, tagsbase, timestamp, dedup, archive)
+    parseCapacity('summary', spaceReport, tagsbase, timestamp, dedup, archive)
 
     if spaceReport.efficientCapacity:
-        parseCapacity('efficientcapacity', spaceReport, tagsbase, timestamp)
+        parseCapacity('efficientcapacity', spaceReport, tagsbase, timestamp, dedup, archive)
 
     for object in spaceReport.spaceDetail.spaceUsageByObjectType:
-        parseCapacity(object.objType, object, tagsbase, timestamp)
+        parseCapacity(object.objType, object, tagsbase, timestamp, dedup, archive)
+
+    if args.capacityObjects:
+        getCapacityObjects(args, tagsbase, cluster_obj, vcMos, vms, vmDisks, spaceReport, timestamp, dedup, archive)
     
     # Get informations about VsanClusterBalancePerDiskInfo
     vsanClusterHealthSystem = vcMos['vsan-cluster-health-system']
@@ -479,7 +1014,11 @@ def getCapacity(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms):
     for disk in clusterHealth.diskBalance.disks:
         measurement = 'capacity_diskBalance'
 
-        tags = tagsbase
+        # Disks of unreachable hosts are not in the inventory
+        if disk.uuid not in disks:
+            continue
+
+        tags = dict(tagsbase)
         tags['uuid'] = disk.uuid
         tags['hostname'] = disks[disk.uuid]
 
@@ -491,46 +1030,222 @@ def getCapacity(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms):
         fields['fullnessAboveThreshold'] = disk.fullnessAboveThreshold
         fields['dataToMoveB'] = disk.dataToMoveB
 
-        printInfluxLineProtocol(measurement, tags, fields, timestamp)
+        printInfluxLineProtocol(measurement, tags, fields, timestamp, dedup, archive)
 
 
-def getHealth(args, tagsbase, cluster_obj, vcMos,):
+# Query the storage usage of a page of vSAN objects, None if the query failed
+def queryObjectsSpaceSummary(vsanObjectSystem, cluster_obj, objUuids):
 
-    vsanClusterHealthSystem = vcMos['vsan-cluster-health-system']
+    try:
+        objectIdentities = vsanObjectSystem.VsanQueryObjectIdentities(
+            cluster=cluster_obj,
+            objUuids=objUuids,
+            includeObjIdentity=False,
+            includeSpaceSummary=True
+        )
+    except (vmodl.MethodFault, OSError) as e:
+        print("Caught exception while querying the storage usage of vSAN objects : " + str(e))
+        return None
+
+    return objectIdentities.spaceSummary or []
+
+
+# List the vSAN objects of a type, None if the query failed
+def queryObjectsIdentities(vsanObjectSystem, cluster_obj, objType):
 
     try:
-        clusterHealth = vsanClusterHealthSystem.VsanQueryVcClusterHealthSummary(
-            cluster=cluster_obj
+        objectIdentities = vsanObjectSystem.VsanQueryObjectIdentities(
+            cluster=cluster_obj,
+            objTypes=[objType],
+            includeObjIdentity=True,
+            includeSpaceSummary=False
         )
-    except vmodl.fault.NotFound as e:
-        print("Caught NotFound exception : " + str(e))
-        return
-    except vmodl.fault.RuntimeFault as e:
-        print("Caught RuntimeFault exception : " + str(e))
-        return
+    except vmodl.fault.InvalidArgument:
+        # Some types of the space report are overheads, not object types
+        return []
+    except (vmodl.MethodFault, OSError) as e:
+        print("Caught exception while listing the vSAN objects of type %s : %s" % (objType, str(e)))
+        return None
 
-    timestamp = int(time.time() * 1000000000)
+    return objectIdentities.identities or []
 
-    for group in clusterHealth.groups:
 
-        splitGroupId = group.groupId.split('.')
-        testName = splitGroupId[-1]
+# Output the storage usage of each vSAN object and of each VM
+# The usage of the objects is stored in a cache file. The objects of a type are only listed and queried again when
+# the used space of their type has changed or when they have been listed more than the TTL of the inventory ago:
+# on a live cluster, the used space of the vdisk objects changes at almost every run
+# The vdisk objects are found from the virtual disks of the VMs and queried by pages, the other types are listed type by type
+def getCapacityObjects(args, tagsbase, cluster_obj, vcMos, vms, vmDisks, spaceReport, timestamp, dedup=None, archive=None):
 
-        parseHealth(testName, group.groupHealth, tagsbase, timestamp)
+    vsanObjectSystem = vcMos['vsan-cluster-object-system']
 
+    objectsfilename = getCacheFilename(args, 'objects')
 
-def isFilesExist(listFile):
-    result = True
-    for file in listFile:
-        if not os.path.isfile(file):
-            result = False
+    cache = {'listed': {}, 'objects': {}}
 
-    return result
+    if isFilesExist((objectsfilename,)):
+        cache = pickelLoadObject(objectsfilename)
 
+    # Used space of each object type when it has been listed, and the time it has been listed
+    listed = cache.get('listed', {})
 
-def isTTLOver(listFile, TTL):
-    result = True
-    for file in listFile:
+    # Used space of each object type, ex: vdisk, vmswap...
+    types = {}
+
+    for object in spaceReport.spaceDetail.spaceUsageByObjectType:
+        types[object.objType] = object.usedB
+
+    cachedObjectsByType = {}
+
+    for objUuid, object in cache['objects'].items():
+        cachedObjectsByType.setdefault(object['type'], {})[objUuid] = object
+
+    objects = {}
+    changedTypes = []
+    now = time.time()
+
+    for objType, usedB in types.items():
+        cachedObjects = cachedObjectsByType.get(objType, {})
+
+        if objType in listed and listed[objType]['usedB'] == usedB and now - listed[objType]['time'] < args.cacheTTL * 60 and all(object['fields'] for object in cachedObjects.values()):
+            objects.update(cachedObjects)
+        else:
+            changedTypes.append(objType)
+
+    failedTypes = []
+
+    objUuids = []
+
+    # The vdisk objects are known from the virtual disks of the VMs, the ones not attached to a VM of the cluster are not found
+    listedTypes = [objType for objType in changedTypes if objType != 'vdisk']
+
+    if 'vdisk' in changedTypes:
+
+        if vmDisks is None:
+            failedTypes.append('vdisk')
+        else:
+            for vm, vmDisksOfVm in vmDisks.items():
+                for disk in vmDisksOfVm:
+                    for objUuid in disk['objects']:
+                        objects[objUuid] = {'type': 'vdisk', 'vm': vm, 'fields': None}
+                        objUuids.append(objUuid)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=args.capacityThreads) as executor:
+
+        # The objects of the changed types are listed type by type, instead of all the objects of the cluster at once
+        for objType, identities in zip(listedTypes, executor.map(lambda objType: queryObjectsIdentities(vsanObjectSystem, cluster_obj, objType), listedTypes)):
+
+            if identities is None:
+                failedTypes.append(objType)
+                continue
+
+            for identity in identities:
+                objects[identity.uuid] = {'type': identity.type, 'vm': identity.vmInstanceUuid, 'fields': None}
+                objUuids.append(identity.uuid)
+
+        # Query the storage usage of the listed objects, by pages queried concurrently
+        # A failed page is skipped, its objects are queried again at the next run
+        pages = [objUuids[i:i + args.capacityPageSize] for i in range(0, len(objUuids), args.capacityPageSize)]
+
+        for spaceSummaries in executor.map(lambda page: queryObjectsSpaceSummary(vsanObjectSystem, cluster_obj, page), pages):
+            for spaceSummary in spaceSummaries or []:
+                if spaceSummary.objUuid in objects:
+                    objects[spaceSummary.objUuid]['fields'] = parseVsanObjectSpaceSummary(spaceSummary)
+
+    usageByVm = {}
+
+    for objUuid, object in objects.items():
+
+        if not object['fields']:
+            continue
+
+        tags = {}
+        tags['uuid'] = objUuid
+        tags['type'] = object['type']
+
+        if object['vm'] in vms:
+            tags['vmname'] = vms[object['vm']]
+
+            vmFields = usageByVm.setdefault(object['vm'], {})
+
+            for key, val in object['fields'].items():
+                vmFields[key] = vmFields.get(key, 0) + val
+
+        tags.update(tagsbase)
+
+        printInfluxLineProtocol('capacity_object', tags, object['fields'], timestamp, dedup, archive)
+
+    for vm, fields in usageByVm.items():
+
+        tags = {}
+        tags['uuid'] = vm
+        tags['vmname'] = vms[vm]
+        tags.update(tagsbase)
+
+        printInfluxLineProtocol('capacity_vm', tags, fields, timestamp, dedup, archive)
+
+    # The types which couldn't be listed are listed again at the next run
+    listed = dict((objType, value) for objType, value in listed.items() if objType in types and objType not in changedTypes)
+
+    for objType in changedTypes:
+        if objType not in failedTypes:
+            listed[objType] = {'usedB': types[objType], 'time': now}
+
+    cache = {'listed': listed, 'objects': objects}
+
+    pickelDumpObject(cache, objectsfilename)
+
+
+def getHealth(args, tagsbase, cluster_obj, vcMos, dedup=None, archive=None):
+
+    vsanClusterHealthSystem = vcMos['vsan-cluster-health-system']
+
+    try:
+        clusterHealth = vsanClusterHealthSystem.VsanQueryVcClusterHealthSummary(
+            cluster=cluster_obj
+        )
+    except vmodl.fault.NotFound as e:
+        print("Caught NotFound exception : " + str(e))
+        return
+    except vmodl.fault.RuntimeFault as e:
+        print("Caught RuntimeFault exception : " + str(e))
+        return
+
+    timestamp = int(time.time() * 1000000000)
+
+    for group in clusterHealth.groups:
+
+        splitGroupId = group.groupId.split('.')
+        testName = splitGroupId[-1]
+
+        parseHealth(testName, group.groupHealth, tagsbase, timestamp, dedup, archive)
+
+
+# Cache file of a cluster, in a subfolder of each vCenter: clusters of different vCenters can have the same name
+def getCacheFilename(args, kind):
+
+    folder = os.path.join(args.cachefolder, args.vcenter)
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    return os.path.join(folder, 'vsanmetrics_' + kind + '-' + args.clusterName + '.cache')
+
+
+def isFilesExist(listFile):
+    result = True
+    for file in listFile:
+        if not os.path.isfile(file):
+            result = False
+
+    return result
+
+
+def isTTLOver(listFile, TTL):
+    result = True
+    for file in listFile:
         if os.path.isfile(file):
             filemodificationtime = datetime.fromtimestamp(os.stat(file).st_mtime)  # This is a datetime.datetime object!
             now = datetime.today()
@@ -542,18 +1257,204 @@ def isTTLOver(listFile, TTL):
     return result
 
 
-def isHostsConnected(cluster, witnessHosts, si):
-    result = True
-    for host in cluster.host:
-        if not host.summary.runtime.connectionState == 'connected':
-            result = False
+# Number of VMs retrieved at once with their devices, the devices of all the VMs of a large cluster are not sent in one response
+vmDisksPageSize = 500
 
-    for witnesshost in witnessHosts:
-        host = (vim.HostSystem(witnesshost.host._moId, si._stub))
-        if not host.summary.runtime.connectionState == 'connected':
-            result = False
 
-    return result
+# Get the virtual disks of the VMs of the cluster from their devices, in one paged property retrieval
+# For each VM instance uuid, the list of its virtual disks with the vSAN objects of the disk and of its snapshots
+def queryVMDisks(content, cluster):
+
+    hostToVm = vmodl.query.PropertyCollector.TraversalSpec(
+        name='hostToVm',
+        type=vim.HostSystem,
+        path='vm',
+        skip=False
+    )
+
+    clusterToHost = vmodl.query.PropertyCollector.TraversalSpec(
+        name='clusterToHost',
+        type=vim.ClusterComputeResource,
+        path='host',
+        skip=False,
+        selectSet=[hostToVm]
+    )
+
+    objectSpec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=cluster,
+        skip=True,
+        selectSet=[clusterToHost]
+    )
+
+    propertySpec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.VirtualMachine,
+        pathSet=['config.instanceUuid', 'config.hardware.device']
+    )
+
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[objectSpec],
+        propSet=[propertySpec]
+    )
+
+    vmDisks = {}
+
+    result = content.propertyCollector.RetrievePropertiesEx([filterSpec], vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=vmDisksPageSize))
+
+    while result:
+        for object in result.objects:
+            props = dict((prop.name, prop.val) for prop in object.propSet)
+
+            # Inaccessible VMs have no configuration
+            if 'config.instanceUuid' not in props:
+                continue
+
+            vmDisks[props['config.instanceUuid']] = parseVMDisks(props.get('config.hardware.device', []))
+
+        if not result.token:
+            break
+
+        result = content.propertyCollector.ContinueRetrievePropertiesEx(result.token)
+
+    return vmDisks
+
+
+# Prefix of the virtual device node of a disk, by type of controller (ex: scsi0:1)
+vmDiskControllers = (
+    ('VirtualSCSIController', 'scsi'),
+    ('VirtualIDEController', 'ide'),
+    ('VirtualAHCIController', 'sata'),
+    ('VirtualNVMEController', 'nvme')
+)
+
+
+# Get the virtual disks of a VM from its devices
+# For each disk, its key and its virtual device node, as in the entityRefIds of virtual-disk and vscsi
+def parseVMDisks(devices):
+
+    vmDisks = []
+
+    controllers = {}
+
+    for device in devices:
+        for controllerType, prefix in vmDiskControllers:
+            if isinstance(device, getattr(vim.vm.device, controllerType)):
+                controllers[device.key] = '%s%i' % (prefix, device.busNumber)
+
+    for device in devices:
+
+        if not isinstance(device, vim.vm.device.VirtualDisk):
+            continue
+
+        # The vSAN objects of the disk and of its snapshots, the disks of the other datastores have none
+        objects = []
+        backing = device.backing
+
+        while backing is not None:
+            if getattr(backing, 'backingObjectId', None):
+                objects.append(backing.backingObjectId)
+
+            backing = getattr(backing, 'parent', None)
+
+        node = None
+
+        if device.controllerKey in controllers and device.unitNumber is not None:
+            node = '%s:%i' % (controllers[device.controllerKey], device.unitNumber)
+
+        vmDisks.append({'objects': objects, 'key': device.key, 'node': node})
+
+    return vmDisks
+
+
+# EntityRefIds of the virtual-disk or vscsi entities of the virtual disks of the VMs
+# ex: virtual-disk:<VM instance uuid>/2000, vscsi:<VM instance uuid>|scsi0:0
+def getVMDisksEntityRefIds(entityType, vmDisks):
+
+    entityRefIds = []
+
+    for vm, vmDisksOfVm in vmDisks.items():
+        for disk in vmDisksOfVm:
+            if entityType == 'virtual-disk':
+                entityRefIds.append('virtual-disk:%s/%i' % (vm, disk['key']))
+            elif disk['node']:
+                entityRefIds.append('vscsi:%s|%s' % (vm, disk['node']))
+
+    return entityRefIds
+
+
+# Get the virtual disks of the VMs of the cluster, they are stored in a cache file until the TTL of the inventory is over
+def getVMDisks(args, content, cluster):
+
+    vmdisksfilename = getCacheFilename(args, 'vmdisks')
+
+    if isFilesExist((vmdisksfilename,)) and not isTTLOver((vmdisksfilename,), args.cacheTTL):
+        return pickelLoadObject(vmdisksfilename)
+
+    vmDisks = queryVMDisks(content, cluster)
+
+    pickelDumpObject(vmDisks, vmdisksfilename)
+
+    return vmDisks
+
+
+# The virtual-disk or vscsi entity types are queried by shards
+def isVMDisksSharded(args):
+
+    if not args.performance or args.processes <= 1:
+        return False
+
+    shardTypes = set(args.shardentitytypes.split(',')) & set(('virtual-disk', 'vscsi'))
+
+    if args.skipentitytypes:
+        shardTypes -= set(args.skipentitytypes.split(','))
+
+    return bool(shardTypes - set(args.entities))
+
+
+# Get the name and the connection state of the hosts of the cluster and of the witness hosts, in one property retrieval
+def getHostsConnectionState(si, content, cluster, witnessHosts):
+
+    objectSpecs = []
+
+    # Hosts of the cluster
+    traversalSpec = vmodl.query.PropertyCollector.TraversalSpec(
+        name='clusterToHost',
+        type=vim.ClusterComputeResource,
+        path='host',
+        skip=False
+    )
+
+    objectSpecs.append(vmodl.query.PropertyCollector.ObjectSpec(
+        obj=cluster,
+        skip=True,
+        selectSet=[traversalSpec]
+    ))
+
+    # Witness hosts
+    for witnessHost in witnessHosts:
+        objectSpecs.append(vmodl.query.PropertyCollector.ObjectSpec(
+            obj=vim.HostSystem(witnessHost.host._moId, si._stub),
+            skip=False
+        ))
+
+    propertySpec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.HostSystem,
+        pathSet=['name', 'runtime.connectionState']
+    )
+
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=objectSpecs,
+        propSet=[propertySpec]
+    )
+
+    hosts = {}
+
+    for object in content.propertyCollector.RetrieveContents([filterSpec]):
+        hosts[object.obj._moId] = {}
+
+        for prop in object.propSet:
+            hosts[object.obj._moId][prop.name] = prop.val
+
+    return hosts
 
 
 def pickelDumpObject(object, filename):
@@ -576,7 +1477,7 @@ def pickelLoadObject(filename):
 
 # Gather informations about uuid, disks and hostnames
 # Store them in cache files if needed
-def manageData(args, si, cluster_obj, vcMos):
+def manageData(args, si, content, cluster_obj, vcMos):
 
     vsanVcStretchedClusterSystem = vcMos['vsan-stretched-cluster-system']
 
@@ -587,201 +1488,1670 @@ def manageData(args, si, cluster_obj, vcMos):
     )
 
     # Build cache's file names
-    uuidfilename = os.path.join(args.cachefolder, 'vsanmetrics_uuid-' + args.clusterName + '.cache')
-    disksfilename = os.path.join(args.cachefolder, 'vsanmetrics_disks-' + args.clusterName + '.cache')
-    vmsfilename = os.path.join(args.cachefolder, 'vsanmetrics_vms-' + args.clusterName + '.cache')
+    uuidfilename = getCacheFilename(args, 'uuid')
+    disksfilename = getCacheFilename(args, 'disks')
+    vmsfilename = getCacheFilename(args, 'vms')
+    diskgroupsfilename = getCacheFilename(args, 'diskgroups')
 
-    listFile = (uuidfilename, disksfilename, vmsfilename)
+    listFile = (uuidfilename, disksfilename, vmsfilename, diskgroupsfilename)
 
-    # By default, don't rebuild cache
-    rebuildcache = False
+    hosts = getHostsConnectionState(si, content, cluster_obj, witnessHosts)
 
-    # Test if all needed cache files exists, if all hosts are connected and if TTL of the cache is not over
+    # Hosts which can't be reached, their disks are skipped
+    excludedHosts = {}
+
+    for host in hosts.values():
+        if not host['runtime.connectionState'] == 'connected':
+            excludedHosts[host['name']] = host['runtime.connectionState']
+
+    # Test if all needed cache files exists and if TTL of the cache is not over
     resultFilesExist = isFilesExist(listFile)
-    resultHostConnected = isHostsConnected(cluster_obj, witnessHosts, si)
     resultTTLOver = isTTLOver(listFile, args.cacheTTL)
 
     # Make decision if rebuilding cache is needed
-    if not resultFilesExist and not resultHostConnected:
-        print("One or more host disconnected. Can't continue")
-        return
+    # When a host is disconnected, an expired cache is still better than an inventory without its disks
+    if resultFilesExist and (not resultTTLOver or excludedHosts):
+        # Load data from cache
+        uuid = pickelLoadObject(uuidfilename)
+        disks = pickelLoadObject(disksfilename)
+        vms = pickelLoadObject(vmsfilename)
+        diskgroups = pickelLoadObject(diskgroupsfilename)
+
     else:
-        if not resultFilesExist and resultHostConnected:
-            rebuildcache = True
-        elif resultFilesExist and resultHostConnected and not resultTTLOver:
-            rebuildcache = False
-        elif resultFilesExist and resultHostConnected and resultTTLOver:
-            rebuildcache = True
-
-    if rebuildcache:
         # Rebuild cache
         # Get uuid/names relationship informations for hosts and disks
-        uuid, disks = getInformations(witnessHosts, cluster_obj, si)
+        uuid, disks, diskgroups = getInformations(witnessHosts, cluster_obj, si, hosts)
 
         # Get VM uuid/names
         vms = getVMs(cluster_obj)
 
-        pickelDumpObject(uuid, uuidfilename)
-        pickelDumpObject(disks, disksfilename)
-        pickelDumpObject(vms, vmsfilename)
+        # Don't store a partial inventory, it will be rebuilt once all hosts are connected
+        if not excludedHosts:
+            pickelDumpObject(uuid, uuidfilename)
+            pickelDumpObject(disks, disksfilename)
+            pickelDumpObject(vms, vmsfilename)
+            pickelDumpObject(diskgroups, diskgroupsfilename)
 
-    else:
-        # Load data from cache
-        uuid = pickelLoadObject(uuidfilename)
-        disks = pickelLoadObject(disksfilename)
-        vms = pickelLoadObject(vmsfilename)
+    return uuid, disks, vms, diskgroups, excludedHosts
+
+
+# Output the hosts excluded from the collection
+def getExcludedHosts(tagsbase, excludedHosts):
+
+    timestamp = int(time.time() * 1000000000)
+
+    for hostname, connectionState in excludedHosts.items():
+
+        tags = {}
+        tags['hostname'] = hostname
+        tags.update(tagsbase)
+
+        fields = {}
+        fields['connectionState'] = '\"' + connectionState + '\"'
+
+        printInfluxLineProtocol('excluded_host', tags, fields, timestamp)
+
+
+# Entity types already loaded by the process, indexed by cache file name
+entityTypesCache = {}
 
-    return uuid, disks, vms
 
+# Get the supported entity types (ex: vsan-host-net) with their labels and units
+# The schema only changes with vSAN upgrades, so it is stored in a cache file named after the vCenter version
+def getEntityTypes(cachefolder, content, vcMos):
 
-def getPerformance(args, tagsbase, si, cluster_obj, vcMos, uuid, disks, vms):
+    entitytypesfilename = os.path.join(cachefolder, 'vsanmetrics_entitytypes-%s-%s.cache' % (content.about.version, content.about.build))
+
+    if entitytypesfilename in entityTypesCache:
+        return entityTypesCache[entitytypesfilename]
+
+    if isFilesExist((entitytypesfilename,)):
+        entityTypesCache[entitytypesfilename] = pickelLoadObject(entitytypesfilename)
+
+        return entityTypesCache[entitytypesfilename]
 
     vsanPerfSystem = vcMos['vsan-performance-manager']
 
-    # Gather a list of the available entity types (ex: vsan-host-net)
-    entityTypes = vsanPerfSystem.VsanPerfGetSupportedEntityTypes()
+    entityTypes = []
 
-    # query interval, last 10 minutes -- UTC !!!
-    endTime = datetime.utcnow()
-    startTime = endTime + timedelta(minutes=-10)
+    for entities in vsanPerfSystem.VsanPerfGetSupportedEntityTypes():
 
-    splitSkipentitytypes = []
+        entityType = {}
+        entityType['name'] = entities.name
+        entityType['description'] = entities.description
+        entityType['graphs'] = []
 
-    if args.skipentitytypes:
-            splitSkipentitytypes = args.skipentitytypes.split(',')
+        # All labels related to the entity (ex: iopsread, iopswrite...) and their unit
+        entityType['labels'] = []
+        entityType['units'] = {}
 
-    result = ""
+        for entity in entities.graphs:
 
-    for entities in entityTypes:
+            graph = {}
+            graph['unit'] = str(entity.unit)
+            graph['metrics'] = []
 
-        if entities.name not in splitSkipentitytypes:
+            for metric in entity.metrics:
 
-            entitieName = entities.name
+                graph['metrics'].append({'label': metric.label, 'name': metric.name, 'description': metric.description})
 
-            labels = []
+                if metric.label not in entityType['units']:
+                    entityType['labels'].append(metric.label)
+                    entityType['units'][metric.label] = graph['unit']
 
-            # Gather all labels related to the entity (ex: iopsread, iopswrite...)
-            for entity in entities.graphs:
+            entityType['graphs'].append(graph)
 
-                for metric in entity.metrics:
+        entityTypes.append(entityType)
 
-                        labels.append(metric.label)
+    pickelDumpObject(entityTypes, entitytypesfilename)
 
-            # Build entity
-            entity = '%s:*' % (entities.name)
+    entityTypesCache[entitytypesfilename] = entityTypes
 
-            # Build spec object
-            spec = vim.cluster.VsanPerfQuerySpec(
-                endTime=endTime,
-                entityRefId=entity,
-                labels=labels,
-                startTime=startTime
-            )
+    return entityTypes
 
-            # Get statistics
+
+# Build the spec objects and get statistics
+def queryPerf(vsanPerfSystem, cluster_obj, entityRefIds, labels, startTime, endTime):
+
+    specs = []
+
+    for entityRefId in entityRefIds:
+        specs.append(vim.cluster.VsanPerfQuerySpec(
+            endTime=endTime,
+            entityRefId=entityRefId,
+            labels=labels,
+            startTime=startTime
+        ))
+
+    return vsanPerfSystem.VsanPerfQueryPerf(
+        querySpecs=specs,
+        cluster=cluster_obj
+    )
+
+
+# Convert the statistics of an entity type to a columnar batch
+# Only the last sample of each entity is kept. Rows share the tag names, the tag values are interned and values are stored in one array
+def buildPerfBatch(measurement, metrics, labels, uuid, vms, disks):
+
+    batch = {}
+    batch['measurement'] = measurement
+    batch['labels'] = labels
+    batch['tagKeys'] = ()
+    batch['timestamps'] = array('q')
+    batch['tags'] = []
+    batch['values'] = array('d')
+
+    columns = {}
+    for column, label in enumerate(labels):
+        columns[label] = column
+
+    timestamps = {}
+    nan = float('nan')
+
+    # Repeated tag values (ex: hostnames) are shared by the rows, this table is released with the batch unlike sys.intern
+    tagValues = {}
+
+    for metric in metrics:
+
+        if not metric.sampleInfo == "":
+
+            sampleInfo = metric.sampleInfo.rpartition(",")[2]
+
+            if sampleInfo not in timestamps:
+                timestamps[sampleInfo] = convertStrToTimestamp(sampleInfo)
+
+            # Entities of unreachable hosts are not in the inventory
             try:
-                metrics = vsanPerfSystem.VsanPerfQueryPerf(
-                    querySpecs=[spec],
-                    cluster=cluster_obj
-                )
+                tags = parseEntityRefId(measurement, metric.entityRefId, uuid, vms, disks)
+            except KeyError:
+                continue
 
-            except vmodl.fault.InvalidArgument as e:
-                print("Caught InvalidArgument exception : " + str(e))
-                return
+            row = [nan] * len(labels)
 
-            except vmodl.fault.NotFound as e:
-                print("Caught NotFound exception : " + str(e))
-                return
+            for value in metric.value:
+                row[columns[value.metricId.label]] = float(value.values.rpartition(",")[2])
 
-            except vmodl.fault.NotSupported as e:
-                print("Caught NotSupported exception : " + str(e))
-                return
+            # All the entities of an entity type have the same tag names
+            batch['tagKeys'] = tuple(tags)
 
-            except vmodl.fault.RuntimeFault as e:
-                print("Caught RuntimeFault exception : " + str(e))
-                return
+            batch['timestamps'].append(timestamps[sampleInfo])
+            batch['tags'].append(tuple(tagValues.setdefault(val, val) for val in tags.values()))
+            batch['values'].extend(row)
 
-            except vmodl.fault.Timedout as e:
-                print("Caught Timedout exception : " + str(e))
-                return
+    return batch
 
-            except vmodl.fault.VsanNodeNotMaster as e:
-                print("Caught VsanNodeNotMaster exception : " + str(e))
-                return
 
-            for metric in metrics:
+# Number of lines of a batch converted and written to the output at once
+# The output of an entity type with many entities is never built as one string
+perfOutputLines = 1000
 
-                if not metric.sampleInfo == "":
 
-                    measurement = entitieName
+# Convert a columnar batch to the Influx Line protocol format, by chunks of lines
+def formatPerfBatch(batch, tagsbase, chunkLines=perfOutputLines):
 
-                    sampleInfos = metric.sampleInfo.split(",")
-                    lenValues = len(sampleInfos)
+    measurement = batch['measurement']
+    labels = batch['labels']
+    tagKeys = batch['tagKeys']
+    values = batch['values']
+    tagsbaseString = arrayToString(tagsbase)
 
-                    timestamp = convertStrToTimestamp(sampleInfos[lenValues - 1])
+    lines = []
 
-                    tags = parseEntityRefId(measurement, metric.entityRefId, uuid, vms, disks)
+    for row, tags in enumerate(batch['tags']):
 
-                    tags.update(tagsbase)
+        offset = row * len(labels)
 
-                    fields = {}
+        fields = []
 
-                    for value in metric.value:
+        for column, label in enumerate(labels):
+            value = values[offset + column]
 
-                        listValue = value.values.split(",")
+            # Labels without value are stored as NaN
+            if value == value:
+                fields.append("%s=%s" % (label, value))
 
-                        fields[value.metricId.label] = float(listValue[lenValues - 1])
+        if not fields:
+            continue
 
-                    result = result + formatInfluxLineProtocol(measurement, tags, fields, timestamp)
+        tagsString = ",".join(["%s=%s" % (key, val) for key, val in zip(tagKeys, tags)] + [tagsbaseString])
 
-    print(result)
+        lines.append("%s,%s %s %i \n" % (measurement, tagsString, ",".join(fields), batch['timestamps'][row]))
 
+        if len(lines) >= chunkLines:
+            yield "".join(lines)
+            lines = []
 
-# Main...
-def main():
+    if lines:
+        yield "".join(lines)
 
-    # Parse CLI arguments
-    args = get_args()
 
-    # Initiate tags with vcenter and cluster name
-    tagsbase = {}
-    tagsbase['vcenter'] = args.vcenter
-    tagsbase['cluster'] = args.clusterName
+# Write a columnar batch to the output, chunk by chunk
+def writePerfBatch(batch, tagsbase):
 
-    try:
-        si, _, cluster_obj, vcMos = connectvCenter(args)
-    except Exception as e:
-        print("MAIN - Caught exception: " + str(e)) 
-        return
+    for chunk in formatPerfBatch(batch, tagsbase):
+        writeOutput(chunk)
 
-    uuid, disks, vms = manageData(args, si, cluster_obj, vcMos)
 
-    threads = list()
+# Merge the batches of the shards of an entity type
+def mergePerfBatches(batches):
 
-    # CAPACITY
-    if args.capacity:
-        x = threading.Thread(target=getCapacity, args=(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms))
-        threads.append(x)
-        x.start()
+    batch = {}
+    batch['measurement'] = batches[0]['measurement']
+    batch['labels'] = batches[0]['labels']
+    batch['tagKeys'] = ()
+    batch['timestamps'] = array('q')
+    batch['tags'] = []
+    batch['values'] = array('d')
 
-    # HEALTH
-    if args.health:
-        x = threading.Thread(target=getHealth, args=(args, tagsbase, cluster_obj, vcMos,))
-        threads.append(x)
-        x.start()
+    for shardBatch in batches:
+        batch['tagKeys'] = shardBatch['tagKeys'] or batch['tagKeys']
+        batch['timestamps'].extend(shardBatch['timestamps'])
+        batch['tags'].extend(shardBatch['tags'])
+        batch['values'].extend(shardBatch['values'])
 
-    # PERFORMANCE
-    if args.performance:
-        x = threading.Thread(target=getPerformance, args=(args, tagsbase, si, cluster_obj, vcMos, uuid, disks, vms,))
-        threads.append(x)
-        x.start()
+    return batch
 
-    for _, thread in enumerate(threads):
-        thread.join()
 
-    return 0
+# Entity types which can be aggregated at a rollup level other than cluster, and these levels
+# The host level needs a hostname tag, virtual-machine, virtual-disk and vscsi don't have one
+rollupLevelTypes = {
+    'host-domclient': ('host',),
+    'host-domcompmgr': ('host',),
+    'vsan-host-net': ('host',),
+    'vsan-vnic-net': ('host',),
+    'vsan-pnic-net': ('host',),
+    'vsan-iscsi-host': ('host',),
+    'cache-disk': ('host', 'diskgroup'),
+    'capacity-disk': ('host', 'diskgroup'),
+    'disk-group': ('host', 'diskgroup'),
+    'virtual-machine': ('vm',),
+    'virtual-disk': ('vm',),
+    'vscsi': ('vm',),
+}
 
-# Start program
-if __name__ == "__main__":
-    main()
 
+# Get the tags of the group of an entity for a rollup level, None if the entity can't be aggregated at this level
+def getRollupGroup(level, tags, disks, vms, diskgroups):
+
+    if level == 'cluster':
+        return ()
+
+    if level == 'host' and 'hostname' in tags:
+        return (tags['hostname'],)
+
+    if level == 'diskgroup' and tags.get('uuid') in diskgroups:
+        diskgroup = diskgroups[tags['uuid']]
+
+        if diskgroup in disks:
+            return (diskgroup, disks[diskgroup])
+
+    if level == 'vm' and tags.get('uuid') in vms:
+        return (tags['uuid'], vms[tags['uuid']])
+
+    return None
+
+
+# Apply an aggregation function to sorted values
+def computeRollup(function, values):
+
+    if not values:
+        return float('nan')
+
+    if function == 'sum':
+        return float(sum(values))
+
+    if function == 'mean':
+        return float(sum(values)) / len(values)
+
+    if function == 'min':
+        return values[0]
+
+    if function == 'max':
+        return values[-1]
+
+    if function == 'count':
+        return float(len(values))
+
+    # Percentile, with linear interpolation between the closest ranks
+    rank = (len(values) - 1) * int(function[1:]) / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+# Aggregate a batch at a rollup level (host, diskgroup, vm or cluster), the result is a new batch
+def buildRollupBatch(batch, level, functions, disks, vms, diskgroups):
+
+    rollupTagKeys = {'cluster': (), 'host': ('hostname',), 'diskgroup': ('diskgroup', 'hostname'), 'vm': ('uuid', 'vmname')}
+
+    labels = batch['labels']
+    tagKeys = batch['tagKeys']
+
+    # Rows of each group
+    groups = {}
+
+    for row, tags in enumerate(batch['tags']):
+        group = getRollupGroup(level, dict(zip(tagKeys, tags)), disks, vms, diskgroups)
+
+        if group is not None:
+            groups.setdefault(group, []).append(row)
+
+    rollup = {}
+    rollup['measurement'] = '%s_%s' % (batch['measurement'], level)
+    rollup['labels'] = ['%s_%s' % (label, function) for label in labels for function in functions]
+    rollup['tagKeys'] = rollupTagKeys[level]
+    rollup['timestamps'] = array('q')
+    rollup['tags'] = []
+    rollup['values'] = array('d')
+
+    # One strided slice of the value matrix for each label
+    columns = [batch['values'][column::len(labels)] for column in range(len(labels))]
+
+    for group, rows in groups.items():
+
+        rollup['timestamps'].append(max(batch['timestamps'][row] for row in rows))
+        rollup['tags'].append(group)
+
+        for column in columns:
+            # Labels without value are stored as NaN
+            values = sorted(column[row] for row in rows if column[row] == column[row])
+
+            for function in functions:
+                rollup['values'].append(computeRollup(function, values))
+
+    return rollup
+
+
+# Output a batch and the rollups of its entity type
+def outputPerfBatch(args, batch, tagsbase, disks, vms, diskgroups, archive=None):
+
+    # The archive keeps the raw series, even when only the rollups are output
+    if archive is not None:
+        writeArchiveChunk(archive, batchToTable(batch))
+
+    if batch['measurement'] in args.rollup:
+
+        for level in args.rollup[batch['measurement']]:
+            writePerfBatch(buildRollupBatch(batch, level, args.rollupfunctions, disks, vms, diskgroups), tagsbase)
+
+        if args.rolluponly:
+            return
+
+    writePerfBatch(batch, tagsbase)
+
+
+# State of a performance worker process, set once by initPerfWorker
+perfWorker = {}
+
+
+# Stub of the vSAN endpoint of a vCenter reusing the session of its cookie, a call on it fails once its socket waits over the timeout
+# vsanapiutils builds its stubs from the host and the cookie only, the timeout of the connection would be dropped
+def getVsanStub(vcenter, port, cookie, apiVersion, timeout):
+
+    stub = SoapStubAdapter(host=vcenter, port=int(port), path='/vsanHealth', version=apiVersion,
+                           sslContext=ssl._create_unverified_context(), httpConnectionTimeout=timeout)
+    stub.cookie = cookie
+
+    return stub
+
+
+# vSAN performance manager on its own connection, whose socket timeout is the timeout of the queries
+# A query over its timeout ends before it is retried, the managers are reused for the same timeout
+def getPerfSystem(perfSystems, vcenter, port, cookie, apiVersion, timeout):
+
+    timeout = int(math.ceil(timeout))
+
+    if timeout not in perfSystems:
+        stub = getVsanStub(vcenter, port, cookie, apiVersion, timeout)
+        perfSystems[timeout] = vim.cluster.VsanPerformanceManager('vsan-performance-manager', stub)
+
+    return perfSystems[timeout]
+
+
+# Close the connections of the performance managers
+def closePerfSystems(perfSystems):
+
+    for perfSystem in perfSystems.values():
+        perfSystem._stub.DropConnections()
+
+    perfSystems.clear()
+
+
+# Build the vSAN performance manager of a worker process
+# The worker reuses the session of the main process instead of login again
+def initPerfWorker(vcenter, port, cookie, apiVersion, clusterMoId, uuid, vms, disks):
+
+    # Worker processes are spawned, they load the vSAN API on their own
+    loadVsanModules()
+
+    perfWorker['session'] = (vcenter, port, cookie, apiVersion)
+    perfWorker['perfSystems'] = {}
+    perfWorker['cluster'] = vim.ClusterComputeResource(clusterMoId)
+    perfWorker['uuid'] = uuid
+    perfWorker['vms'] = vms
+    perfWorker['disks'] = disks
+
+
+# Query and parse a shard of entities of an entity type in a worker process
+# Return the batch and the duration of the query, None if the query failed
+def queryPerfShard(entitieName, entityRefIds, labels, startTime, endTime, retries, timeout):
+
+    vsanPerfSystem = getPerfSystem(perfWorker['perfSystems'], *perfWorker['session'], timeout=timeout)
+
+    try:
+        metrics, duration = retryQuery(lambda: queryPerf(vsanPerfSystem, perfWorker['cluster'], entityRefIds, labels, startTime, endTime), retries)
+    except (vmodl.MethodFault, OSError) as e:
+        print("Caught exception while querying a shard of %s : %s" % (entitieName, str(e)))
+        return None
+
+    return buildPerfBatch(entitieName, metrics, labels, perfWorker['uuid'], perfWorker['vms'], perfWorker['disks']), duration
+
+
+# Run a query with bounded retries and a jittered exponential backoff, only transient faults are retried
+# Return the result and the duration of the successful attempt
+def retryQuery(function, retries):
+
+    for attempt in range(retries + 1):
+        try:
+            start = time.time()
+            result = function()
+
+            return result, time.time() - start
+
+        except (vmodl.fault.InvalidArgument, vim.fault.NotFound, vmodl.fault.NotSupported):
+            raise
+
+        # A socket timeout of the connection is an OSError
+        except (OSError, vim.fault.Timedout, vim.fault.VsanNodeNotMaster, vmodl.RuntimeFault):
+            if attempt == retries:
+                raise
+
+            time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+
+
+# Load the state of the entity types of the cluster: durations of the last queries and consecutive failures
+def loadPerfState(args):
+
+    perfstatefilename = getCacheFilename(args, 'perfstate')
+
+    if isFilesExist((perfstatefilename,)):
+        return pickelLoadObject(perfstatefilename)
+
+    return {}
+
+
+def savePerfState(args, perfState):
+
+    perfstatefilename = getCacheFilename(args, 'perfstate')
+
+    pickelDumpObject(perfState, perfstatefilename)
+
+
+# Timeout of the query of an entity type, three times its slowest recent duration
+def getPerfTimeout(args, typeState):
+
+    if not typeState['durations']:
+        return args.perftimeout
+
+    return min(args.perftimeout, max(10, 3 * max(typeState['durations'])))
+
+
+def recordPerfSuccess(typeState, duration):
+
+    typeState['durations'] = (typeState['durations'] + [duration])[-10:]
+    typeState['failures'] = 0
+
+
+# After 3 consecutive failed runs, the entity type is skipped until the cooldown is over
+def recordPerfFailure(args, typeState):
+
+    typeState['failures'] += 1
+
+    if typeState['failures'] >= 3:
+        typeState['skipUntil'] = time.time() + args.perfcooldown * 60
+
+
+def getPerformance(args, tagsbase, si, content, cluster_obj, vcMos, uuid, disks, vms, diskgroups, vmDisks=None, archive=None):
+
+    vsanPerfSystem = vcMos['vsan-performance-manager']
+
+    # Performance managers of the queries, one for each timeout
+    perfSystems = {}
+
+    # Gather a list of the available entity types (ex: vsan-host-net)
+    entityTypes = getEntityTypes(args.cachefolder, content, vcMos)
+
+    # query interval, last 10 minutes -- UTC !!!
+    endTime = datetime.utcnow()
+    startTime = endTime + timedelta(minutes=-10)
+
+    splitSkipentitytypes = []
+
+    if args.skipentitytypes:
+            splitSkipentitytypes = args.skipentitytypes.split(',')
+
+    # Large entity types are split in shards of explicit entities, queried and parsed by a pool of processes
+    splitShardentitytypes = []
+
+    if args.processes > 1:
+        splitShardentitytypes = args.shardentitytypes.split(',')
+
+    # The entities of the sharded entity types are known from the last query of all of them ('<type>:*')
+    # The virtual disks and vscsi are known from the devices of the VMs instead, their query of all of them is not run every hour
+    entitiesfilename = getCacheFilename(args, 'entities')
+
+    entityRefIdsCache = {}
+
+    if isFilesExist((entitiesfilename,)) and not isTTLOver((entitiesfilename,), args.cacheTTL):
+        entityRefIdsCache = pickelLoadObject(entitiesfilename)
+
+    entityRefIdsFound = {}
+
+    perfState = loadPerfState(args)
+
+    pool = None
+    shards = {}
+
+    for entities in entityTypes:
+
+        if entities['name'] not in splitSkipentitytypes:
+
+            entitieName = entities['name']
+
+            typeState = perfState.setdefault(entitieName, {'durations': [], 'failures': 0, 'skipUntil': 0})
+
+            if typeState['skipUntil'] > time.time():
+                print("Skipping entity type %s after %i consecutive failures" % (entitieName, typeState['failures']))
+                continue
+
+            labels = entities['labels']
+
+            # Only query the allowed labels, vCenter will compute and send less data
+            if entitieName in args.labels:
+                labels = [label for label in labels if label in args.labels[entitieName]]
+
+                if not labels:
+                    print("None of the labels provided for entity type %s are supported" % (entitieName))
+                    continue
+
+            # Build entities, all of them by default or only the requested ones
+            vmFilter = None
+
+            if entitieName in args.entities and entitieName in ('virtual-disk', 'vscsi') and entitieName not in entityRefIdsCache:
+                # The virtual disks and vscsi of the VMs are not known yet: all of them are queried once and filtered by VM
+                vmFilter = set(resolveVM(entityId, vms) for entityId in args.entities[entitieName])
+                unknown = [entityId for entityId in args.entities[entitieName] if not resolveVM(entityId, vms)]
+                entityRefIds = ['%s:*' % (entitieName)]
+
+                if unknown:
+                    print("Unknown entities for entity type %s : %s" % (entitieName, ', '.join(unknown)))
+
+            elif entitieName in args.entities:
+                entityRefIds, unknown = expandEntityFilter(entitieName, args.entities[entitieName], uuid, disks, vms, diskgroups, entityRefIdsCache.get(entitieName, []))
+
+                if unknown:
+                    print("Unknown entities for entity type %s : %s" % (entitieName, ', '.join(unknown)))
+
+                if not entityRefIds:
+                    continue
+            else:
+                entityRefIds = ['%s:*' % (entitieName)]
+
+                if entitieName in splitShardentitytypes:
+
+                    inventory = False
+
+                    # VMs are already known from the inventory cache
+                    if entitieName == 'virtual-machine':
+                        shardEntityRefIds = ['%s:%s' % (entitieName, vm) for vm in vms]
+                    elif entitieName in ('virtual-disk', 'vscsi') and vmDisks is not None and typeState.get('inventory', True):
+                        shardEntityRefIds = getVMDisksEntityRefIds(entitieName, vmDisks)
+                        inventory = True
+                    else:
+                        shardEntityRefIds = entityRefIdsCache.get(entitieName)
+
+                    if shardEntityRefIds:
+
+                        if not pool:
+                            import multiprocessing
+
+                            pool = multiprocessing.get_context('spawn').Pool(
+                                processes=args.processes,
+                                initializer=initPerfWorker,
+                                initargs=(args.vcenter, args.port, si._stub.cookie, vsanPerfSystem._stub.version, cluster_obj._moId, uuid, vms, disks)
+                            )
+
+                        shards[entitieName] = {'start': time.time(), 'results': [], 'inventory': inventory}
+
+                        for i in range(0, len(shardEntityRefIds), args.shardsize):
+                            shards[entitieName]['results'].append(pool.apply_async(queryPerfShard, (entitieName, shardEntityRefIds[i:i + args.shardsize], labels, startTime, endTime, args.perfretries, getPerfTimeout(args, typeState))))
+
+                        continue
+
+            # Get statistics
+            # A failure only skips this entity type, the other ones are still collected
+            perfSystem = getPerfSystem(perfSystems, args.vcenter, args.port, si._stub.cookie, vsanPerfSystem._stub.version, getPerfTimeout(args, typeState))
+
+            try:
+                metrics, duration = retryQuery(lambda: queryPerf(perfSystem, cluster_obj, entityRefIds, labels, startTime, endTime), args.perfretries)
+
+            except (vmodl.MethodFault, OSError) as e:
+                print("Caught exception while querying %s : %s" % (entitieName, str(e)))
+                recordPerfFailure(args, typeState)
+                continue
+
+            recordPerfSuccess(typeState, duration)
+
+            # The entities queried all at once are kept for the shards and for the filters by VM
+            if entityRefIds == ['%s:*' % (entitieName)] and (entitieName in splitShardentitytypes or entitieName in ('virtual-disk', 'vscsi')):
+                entityRefIdsFound[entitieName] = [metric.entityRefId for metric in metrics]
+
+                # The entities derived from the devices of the VMs are used again once vSAN knows some of them
+                if entitieName in ('virtual-disk', 'vscsi') and vmDisks is not None and entityRefIdsFound[entitieName]:
+                    typeState['inventory'] = not set(entityRefIdsFound[entitieName]).isdisjoint(getVMDisksEntityRefIds(entitieName, vmDisks))
+
+            if vmFilter is not None:
+                metrics = [metric for metric in metrics if getEntityVM(metric.entityRefId) in vmFilter]
+
+            # Output each entity type as soon as it is parsed, only one of them is kept in memory
+            outputPerfBatch(args, buildPerfBatch(entitieName, metrics, labels, uuid, vms, disks), tagsbase, disks, vms, diskgroups, archive)
+
+    if entityRefIdsFound:
+        entityRefIdsCache.update(entityRefIdsFound)
+        pickelDumpObject(entityRefIdsCache, entitiesfilename)
+
+    # Merge the results of the shards into the output
+    # The shards of an aggregated entity type are merged first, its rollups need all of its entities
+    timedOut = False
+
+    # The queries of the shards end at their socket timeout, the deadline only guards against a stuck worker
+    # Shards are queued behind the ones of the other entity types, and each of them can be retried by its worker
+    waves = -(-sum(len(shard['results']) for shard in shards.values()) // args.processes)
+    backoff = sum(min(30, 2 ** attempt) for attempt in range(args.perfretries))
+
+    for entitieName, shard in shards.items():
+
+        typeState = perfState[entitieName]
+
+        deadline = shard['start'] + waves * (getPerfTimeout(args, typeState) * (args.perfretries + 1) + backoff)
+
+        batches = []
+        durations = []
+        failed = False
+        rows = 0
+
+        for result in shard['results']:
+            try:
+                shardResult = result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                shardResult = None
+                timedOut = True
+
+            if shardResult is None:
+                failed = True
+                continue
+
+            batch, duration = shardResult
+            durations.append(duration)
+            rows += len(batch['tags'])
+
+            if entitieName in args.rollup:
+                batches.append(batch)
+            else:
+                outputPerfBatch(args, batch, tagsbase, disks, vms, diskgroups, archive)
+
+        if batches:
+            outputPerfBatch(args, mergePerfBatches(batches), tagsbase, disks, vms, diskgroups, archive)
+
+        if failed:
+            print("Some shards of entity type %s failed or timed out" % (entitieName))
+            recordPerfFailure(args, typeState)
+        else:
+            # None of the entities derived from the devices of the VMs are known by vSAN: they are listed by vSAN from the next run
+            if shard['inventory'] and not rows:
+                print("No results for the entities of entity type %s found from the devices of the VMs" % (entitieName))
+                typeState['inventory'] = False
+
+            # The timeout applies to each shard, the slowest one is recorded
+            recordPerfSuccess(typeState, max(durations))
+
+    closePerfSystems(perfSystems)
+
+    if pool:
+        # Workers still waiting for an answer are killed
+        if timedOut:
+            pool.terminate()
+        else:
+            pool.close()
+            pool.join()
+
+    savePerfState(args, perfState)
+
+
+# Lock of the archive, results are archived by the concurrent collection threads
+archiveLock = threading.Lock()
+
+
+# Archive of a run, chunks are partitioned by vCenter, cluster, measurement and day
+def newArchive(args):
+
+    archive = {}
+    archive['folder'] = os.path.join(args.archive, args.vcenter, args.clusterName)
+    archive['run'] = int(time.time() * 1000000000)
+    archive['chunks'] = 0
+    archive['rows'] = {}
+    archive['partitions'] = set()
+    archive['compact'] = args.archiveCompact
+
+    return archive
+
+
+# Record a capacity or health line, they are written in one chunk per measurement at the end of the run
+def archiveRow(archive, measurement, tags, fields, timestamp):
+
+    with archiveLock:
+        archive['rows'].setdefault(measurement, []).append((tags, fields, timestamp))
+
+
+# Compact the partitions written by the run which reached the threshold, and the partitions of the previous day
+# A closed day is merged in one chunk, the current day in at most one chunk for each threshold of runs
+def compactArchive(archive):
+
+    for folder in archive['partitions']:
+
+        previousDay = (datetime.strptime(os.path.basename(folder), '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        previousFolder = os.path.join(os.path.dirname(folder), previousDay)
+
+        try:
+            if len(listArchiveChunks(folder)[0]) >= archive['compact']:
+                compactArchivePartition(folder)
+
+            if os.path.isdir(previousFolder):
+                compactArchivePartition(previousFolder)
+        except (OSError, ValueError) as e:
+            print("Caught exception while compacting the archive : " + str(e))
+
+
+def writeArchiveRows(archive):
+
+    for measurement, rows in archive['rows'].items():
+        writeArchiveChunk(archive, rowsToTable(measurement, rows))
+
+
+# Convert a columnar batch to a table: timestamps, one list of values for each tag and one array of values for each label
+def batchToTable(batch):
+
+    table = {}
+    table['measurement'] = batch['measurement']
+    table['timestamps'] = batch['timestamps']
+    table['tags'] = {}
+    table['fields'] = {}
+
+    for column, key in enumerate(batch['tagKeys']):
+        table['tags'][key] = [tags[column] for tags in batch['tags']]
+
+    for column, label in enumerate(batch['labels']):
+        table['fields'][label] = batch['values'][column::len(batch['labels'])]
+
+    return table
+
+
+# Convert lines of a measurement to a table, string fields are kept as lists
+def rowsToTable(measurement, rows):
+
+    table = {}
+    table['measurement'] = measurement
+    table['timestamps'] = array('q', [timestamp for _, _, timestamp in rows])
+    table['tags'] = {}
+    table['fields'] = {}
+
+    for tags, fields, _ in rows:
+        for key in tags:
+            table['tags'].setdefault(key, None)
+        for key in fields:
+            table['fields'].setdefault(key, None)
+
+    for key in table['tags']:
+        table['tags'][key] = [str(tags.get(key, '')) for tags, _, _ in rows]
+
+    for key in table['fields']:
+        values = [fields.get(key) for _, fields, _ in rows]
+
+        if any(isinstance(value, str) for value in values):
+            table['fields'][key] = ['' if value is None else str(value).strip('"') for value in values]
+        else:
+            table['fields'][key] = array('d', [float('nan') if value is None else float(value) for value in values])
+
+    return table
+
+
+# Dictionary encoding of a list of strings
+def encodeDictionary(values):
+
+    dictionary = {}
+    indexes = array('I')
+
+    for value in values:
+        indexes.append(dictionary.setdefault(value, len(dictionary)))
+
+    return list(dictionary), indexes
+
+
+# Write a chunk file: a JSON header describing the columns, then each column compressed separately
+# The data of a column is given by parts, a large column is compressed part by part
+def writeChunkFile(filename, header, columns):
+
+    header['columns'] = []
+    offset = 0
+
+    # The offsets of the columns are only known once they are compressed, they are written in a data file first
+    dataFile = open(filename + '.data', 'w+b')
+
+    for column, parts in columns:
+        compressor = zlib.compressobj()
+        length = 0
+
+        for part in parts:
+            blob = compressor.compress(part)
+            dataFile.write(blob)
+            length += len(blob)
+
+        blob = compressor.flush()
+        dataFile.write(blob)
+        length += len(blob)
+
+        column['offset'] = offset
+        column['length'] = length
+
+        header['columns'].append(column)
+        offset += length
+
+    headerData = json.dumps(header).encode('utf-8')
+
+    # Chunks are written under a temporary name, a reader never sees a partial chunk
+    fileObject = open(filename + '.tmp', 'wb')
+    fileObject.write(b'VSMA' + struct.pack('<I', len(headerData)) + headerData)
+
+    dataFile.seek(0)
+
+    while True:
+        blob = dataFile.read(1048576)
+
+        if not blob:
+            break
+
+        fileObject.write(blob)
+
+    fileObject.close()
+    dataFile.close()
+
+    os.remove(filename + '.data')
+    os.replace(filename + '.tmp', filename)
+
+
+# Write a table in a chunk file of its partition
+def writeArchiveChunk(archive, table):
+
+    if not len(table['timestamps']):
+        return
+
+    day = datetime.fromtimestamp(table['timestamps'][0] / 1000000000).strftime('%Y-%m-%d')
+    folder = os.path.join(archive['folder'], table['measurement'], day)
+
+    with archiveLock:
+        archive['chunks'] += 1
+        archive['partitions'].add(folder)
+        filename = os.path.join(folder, '%i-%i.chunk' % (archive['run'], archive['chunks']))
+
+    header = {}
+    header['measurement'] = table['measurement']
+    header['rows'] = len(table['timestamps'])
+
+    columns = [({'kind': 'time', 'name': 'timestamp', 'type': 'q'}, [table['timestamps'].tobytes()])]
+
+    for kind, values in (('tag', table['tags']), ('field', table['fields'])):
+        for name, value in values.items():
+
+            if isinstance(value, array):
+                columns.append(({'kind': kind, 'name': name, 'type': value.typecode}, [value.tobytes()]))
+            else:
+                dictionary, indexes = encodeDictionary(value)
+                columns.append(({'kind': kind, 'name': name, 'type': 'dictionary', 'dictionary': dictionary}, [indexes.tobytes()]))
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    writeChunkFile(filename, header, columns)
+
+
+# Read the header of a chunk file, and the offset of its first column
+def readArchiveHeader(data, filename):
+
+    if not data[:4] == b'VSMA':
+        raise ValueError("Not an archive chunk : " + filename)
+
+    headerLength = struct.unpack('<I', data[4:8])[0]
+
+    return json.loads(data[8:8 + headerLength].decode('utf-8')), 8 + headerLength
+
+
+# Decompress a column of a chunk file, the indexes of a dictionary column are only decoded with decode
+def readArchiveColumn(data, start, column, decode=True):
+
+    blob = zlib.decompress(data[start + column['offset']:start + column['offset'] + column['length']])
+
+    if column['type'] == 'dictionary':
+        indexes = array('I')
+        indexes.frombytes(blob)
+
+        if decode:
+            return [column['dictionary'][index] for index in indexes]
+
+        return indexes
+
+    values = array(column['type'])
+    values.frombytes(blob)
+
+    return values
+
+
+def readArchiveChunkHeader(filename):
+
+    fileObject = open(filename, 'rb')
+    data = mmap.mmap(fileObject.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        return readArchiveHeader(data, filename)[0]
+    finally:
+        data.close()
+        fileObject.close()
+
+
+# Read a chunk file through a memory map, only the requested fields are decompressed (all of them by default)
+def readArchiveChunk(filename, fields=None):
+
+    fileObject = open(filename, 'rb')
+    data = mmap.mmap(fileObject.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        header, start = readArchiveHeader(data, filename)
+
+        table = {}
+        table['measurement'] = header['measurement']
+        table['timestamps'] = array('q')
+        table['tags'] = {}
+        table['fields'] = {}
+
+        for column in header['columns']:
+
+            if column['kind'] == 'field' and fields is not None and column['name'] not in fields:
+                continue
+
+            values = readArchiveColumn(data, start, column)
+
+            if column['kind'] == 'time':
+                table['timestamps'] = values
+            elif column['kind'] == 'tag':
+                table['tags'][column['name']] = values
+            else:
+                table['fields'][column['name']] = values
+    finally:
+        data.close()
+        fileObject.close()
+
+    return table
+
+
+# List the chunks of a partition, without the ones already merged in a compacted chunk
+# Return the chunks and the merged ones, which are only left by an interrupted compaction
+def listArchiveChunks(folder):
+
+    filenames = sorted(filename for filename in os.listdir(folder) if filename.endswith('.chunk'))
+
+    merged = set()
+
+    for filename in filenames:
+        if filename.startswith('compact-'):
+            merged.update(readArchiveChunkHeader(os.path.join(folder, filename)).get('sources', []))
+
+    return [filename for filename in filenames if filename not in merged], merged
+
+
+# Parts of a column of a compacted chunk, read from each chunk of the partition
+# A column missing in a chunk is filled with empty strings or NaN, a dictionary is extended with the values of each chunk
+# and set in the column once all of them have been read, before the header is written
+def getCompactedColumnParts(folder, filenames, headers, column):
+
+    dictionary = {}
+
+    for filename, header in zip(filenames, headers):
+
+        source = None
+
+        for sourceColumn in header['columns']:
+            if sourceColumn['kind'] == column['kind'] and sourceColumn['name'] == column['name']:
+                source = sourceColumn
+
+        if source is None and column['type'] == 'dictionary':
+            yield (array('I', [dictionary.setdefault('', len(dictionary))]) * header['rows']).tobytes()
+            continue
+
+        if source is None:
+            yield (array(column['type'], [float('nan')]) * header['rows']).tobytes()
+            continue
+
+        fileObject = open(os.path.join(folder, filename), 'rb')
+        data = mmap.mmap(fileObject.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            start = readArchiveHeader(data, filename)[1]
+            values = readArchiveColumn(data, start, source, decode=False)
+        finally:
+            data.close()
+            fileObject.close()
+
+        if column['type'] != 'dictionary':
+            yield values.tobytes()
+        elif source['type'] == 'dictionary':
+            mapping = [dictionary.setdefault(value, len(dictionary)) for value in source['dictionary']]
+            yield array('I', [mapping[index] for index in values]).tobytes()
+        else:
+            # A numeric field stored as strings in another chunk, integers keep the format they were collected with
+            values = ['' if value != value else str(int(value)) if value.is_integer() else repr(value) for value in values]
+            yield array('I', [dictionary.setdefault(value, len(dictionary)) for value in values]).tobytes()
+
+    if column['type'] == 'dictionary':
+        column['dictionary'] = list(dictionary)
+
+
+# Merge the chunks of a partition in one compacted chunk, column by column
+# Only one column of the partition is decompressed at a time, the merged chunks are deleted once the compacted chunk is written
+def compactArchivePartition(folder):
+
+    filenames, merged = listArchiveChunks(folder)
+
+    for filename in merged:
+        if os.path.isfile(os.path.join(folder, filename)):
+            os.remove(os.path.join(folder, filename))
+
+    if len(filenames) < 2:
+        return
+
+    headers = [readArchiveChunkHeader(os.path.join(folder, filename)) for filename in filenames]
+
+    # Union of the columns of the chunks, a field stored as strings in one of them is stored as strings
+    columns = {}
+
+    for header in headers:
+        for column in header['columns']:
+            key = (column['kind'], column['name'])
+
+            if key not in columns:
+                columns[key] = {'kind': column['kind'], 'name': column['name'], 'type': column['type']}
+            elif column['type'] == 'dictionary':
+                columns[key]['type'] = 'dictionary'
+
+    compactedColumns = []
+
+    for key in sorted(columns, key=lambda key: ('time', 'tag', 'field').index(key[0])):
+        compactedColumns.append((columns[key], getCompactedColumnParts(folder, filenames, headers, columns[key])))
+
+    compactedHeader = {}
+    compactedHeader['measurement'] = headers[0]['measurement']
+    compactedHeader['rows'] = sum(header['rows'] for header in headers)
+    compactedHeader['sources'] = filenames
+
+    writeChunkFile(os.path.join(folder, 'compact-%i.chunk' % (int(time.time() * 1000000000))), compactedHeader, compactedColumns)
+
+    for filename in filenames:
+        os.remove(os.path.join(folder, filename))
+
+
+# Collect the requested metrics of a cluster, return False if the collection failed
+# A long running caller can provide the session of the vCenter, the clusters found with it and the dedup state of the cluster
+def collectCluster(args, si=None, dedup=None, clusters=None):
+
+    loadVsanModules()
+
+    # Initiate tags with vcenter and cluster name
+    tagsbase = {}
+    tagsbase['vcenter'] = args.vcenter
+    tagsbase['cluster'] = args.clusterName
+
+    try:
+        si, content, cluster_obj, vcMos = connectvCenter(args, si, clusters)
+    except Exception as e:
+        print("MAIN - Caught exception: " + str(e)) 
+        return False
+
+    try:
+        uuid, disks, vms, diskgroups, excludedHosts = manageData(args, si, content, cluster_obj, vcMos)
+    except vmodl.fault.InvalidRequest:
+        # The cached vmodl version doesn't match the vCenter anymore (ex: after an upgrade), probe it again
+        vcMos = getVsanVcMos(args, si, cluster_obj, ssl._create_unverified_context(), refresh=True)
+        uuid, disks, vms, diskgroups, excludedHosts = manageData(args, si, content, cluster_obj, vcMos)
+
+    getExcludedHosts(tagsbase, excludedHosts)
+
+    if args.dedup and dedup is None:
+        dedup = loadDedupState(args)
+    elif dedup is not None:
+        dedup['emitted'] = 0
+        dedup['suppressed'] = 0
+
+    archive = None
+
+    if args.archive:
+        archive = newArchive(args)
+
+    # The virtual disks of the VMs are only retrieved for the storage usage of the vSAN objects and the shards of their performance
+    vmDisks = None
+
+    if (args.capacity and args.capacityObjects) or isVMDisksSharded(args):
+        try:
+            vmDisks = getVMDisks(args, content, cluster_obj)
+        except (vmodl.MethodFault, OSError) as e:
+            print("Caught exception while retrieving the virtual disks of the VMs : " + str(e))
+
+    threads = list()
+
+    # CAPACITY
+    if args.capacity:
+        x = threading.Thread(target=getCapacity, args=(args, tagsbase, cluster_obj, vcMos, uuid, disks, vms, vmDisks, dedup, archive))
+        threads.append(x)
+        x.start()
+
+    # HEALTH
+    if args.health:
+        x = threading.Thread(target=getHealth, args=(args, tagsbase, cluster_obj, vcMos, dedup, archive))
+        threads.append(x)
+        x.start()
+
+    # PERFORMANCE
+    if args.performance:
+        x = threading.Thread(target=getPerformance, args=(args, tagsbase, si, content, cluster_obj, vcMos, uuid, disks, vms, diskgroups, vmDisks, archive,))
+        threads.append(x)
+        x.start()
+
+    for _, thread in enumerate(threads):
+        thread.join()
+
+    if dedup is not None:
+        saveDedupState(args, dedup)
+        getDedupStatistics(tagsbase, dedup)
+
+    if archive is not None:
+        writeArchiveRows(archive)
+        compactArchive(archive)
+
+    return True
+
+
+# Read the fleet configuration file
+# Each section except [fleet] is a vCenter, with its clusters and their vsanmetrics options
+def readFleetConfig(filename):
+
+    config = configparser.ConfigParser(interpolation=None)
+
+    if not config.read(filename):
+        raise Exception("Can't read the fleet configuration file " + filename)
+
+    fleet = {}
+    fleet['interval'] = config.getint('fleet', 'interval', fallback=300)
+    fleet['concurrency'] = config.getint('fleet', 'concurrency', fallback=8)
+    fleet['once'] = config.getboolean('fleet', 'once', fallback=False)
+    fleet['coordination'] = config.get('fleet', 'coordination', fallback=None)
+    fleet['instance'] = config.get('fleet', 'instance', fallback=socket.gethostname() + '-' + str(os.getpid()))
+    fleet['membertimeout'] = config.getint('fleet', 'membertimeout', fallback=60)
+    fleet['collecting'] = set()
+    fleet['vcenters'] = {}
+    fleet['clusters'] = []
+
+    if fleet['membertimeout'] <= 0:
+        raise Exception("The parameter membertimeout must be greater than 0")
+
+    vcenterConcurrency = config.getint('fleet', 'vcenterconcurrency', fallback=2)
+    options = config.get('fleet', 'options', fallback='')
+
+    for vcenter in config.sections():
+
+        if vcenter == 'fleet':
+            continue
+
+        section = config[vcenter]
+
+        if 'user' not in section or 'password' not in section or 'clusters' not in section:
+            raise Exception("The parameters user, password and clusters are required for vCenter " + vcenter)
+
+        fleet['vcenters'][vcenter] = {}
+        fleet['vcenters'][vcenter]['concurrency'] = section.getint('concurrency', fallback=vcenterConcurrency)
+
+        for clusterName in section['clusters'].split(','):
+
+            if not clusterName.strip():
+                continue
+
+            argv = ['--vcenter', vcenter, '--port', section.get('port', '443'), '--user', section['user'], '--password', section['password'], '--cluster_name', clusterName.strip()]
+            argv.extend(shlex.split(section.get('options', options)))
+
+            fleet['clusters'].append(getFleetClusterArgs(vcenter, clusterName.strip(), argv))
+
+    return fleet
+
+
+# Parse and check the options of a cluster of the fleet, an invalid cluster is reported with its vCenter
+def getFleetClusterArgs(vcenter, clusterName, argv):
+
+    try:
+        args = getParser().parse_args(argv)
+    except SystemExit:
+        # The error has been printed by argparse
+        raise Exception("Invalid options for cluster %s of vCenter %s" % (clusterName, vcenter))
+
+    if args.fleet:
+        raise Exception("Invalid options for cluster %s of vCenter %s : --fleet can't be used in the fleet configuration file" % (clusterName, vcenter))
+
+    try:
+        checkArgs(args)
+    except ValueError as e:
+        raise Exception("Invalid options for cluster %s of vCenter %s : %s" % (clusterName, vcenter, str(e)))
+
+    return args
+
+
+# Order the clusters in round robin over the vCenters, the clusters of a vCenter are spread over the interval
+def getFleetSchedule(fleet):
+
+    clustersByVcenter = {}
+
+    for args in fleet['clusters']:
+        clustersByVcenter.setdefault(args.vcenter, []).append(args)
+
+    schedule = []
+
+    while any(clustersByVcenter.values()):
+        for clusters in clustersByVcenter.values():
+            if clusters:
+                schedule.append(clusters.pop(0))
+
+    return schedule
+
+
+# Collect a cluster of the fleet, in a thread of the executor
+# The session of each vCenter is shared by its clusters, it is opened again when it has expired
+def runFleetCollection(args, session, state):
+
+    with session['lock']:
+        if not session['si']:
+            try:
+                session['si'] = loginvCenter(args, disconnectAtExit=False)
+            except Exception as e:
+                print("FLEET - Caught exception: " + str(e))
+                return
+
+            # The clusters found are bound to the previous session
+            session['clusters'].clear()
+
+        si = session['si']
+
+    if args.dedup and state['dedup'] is None:
+        state['dedup'] = loadDedupState(args)
+
+    try:
+        result = collectCluster(args, si, state['dedup'], session['clusters'])
+    except Exception as e:
+        print("FLEET - Caught exception while collecting cluster %s : %s" % (args.clusterName, str(e)))
+        result = False
+
+    # Most failures are not related to the session (ex: cluster not found), it is only opened again when it has expired
+    # The clusters are retrieved again, the cluster may have been renamed or removed
+    if not result:
+        with session['lock']:
+            session['clusters'].clear()
+
+            if session['si'] is si and not isSessionValid(si):
+                disconnectvCenter(si)
+                session['si'] = None
+
+    writeOutput("", flush=True)
+
+
+def closeFleetSession(session):
+
+    with session['lock']:
+        if session['si']:
+            disconnectvCenter(session['si'])
+            session['si'] = None
+
+
+# Collect a cluster every interval, starting at its offset in the interval
+async def runFleetCluster(args, offset, fleet, semaphores, sessions, executor):
+
+    loop = asyncio.get_event_loop()
+
+    # Dedup state of the cluster, kept in memory between the runs
+    state = {'dedup': None}
+
+    nextRun = loop.time() + offset
+
+    while True:
+        await asyncio.sleep(max(0, nextRun - loop.time()))
+
+        owned = True
+        key = args.vcenter + '/' + args.clusterName
+
+        # In coordination mode, a cluster is only collected by the instance holding its lease
+        # A cluster is marked as being collected before its lease is taken, its lease can't be released by the heartbeat meanwhile
+        if fleet['coordination']:
+            fleet['collecting'].add(key)
+
+            owned = await loop.run_in_executor(None, acquireFleetLease, fleet, args)
+
+            # The cluster moved to this instance, the previous instance releases its lease at its next heartbeat
+            while owned is None and loop.time() + fleet['membertimeout'] / 3.0 < nextRun + fleet['interval']:
+                await asyncio.sleep(fleet['membertimeout'] / 3.0)
+                owned = await loop.run_in_executor(None, acquireFleetLease, fleet, args)
+
+            if not owned:
+                fleet['collecting'].discard(key)
+
+        if owned:
+            # The slot of the vCenter is taken first, a cluster waiting for its vCenter doesn't hold a slot of the fleet
+            async with semaphores[args.vcenter]:
+                async with semaphores['fleet']:
+                    await loop.run_in_executor(executor, runFleetCollection, args, sessions[args.vcenter], state)
+
+            fleet['collecting'].discard(key)
+
+        if fleet['once']:
+            return
+
+        # Runs missed during a long collection are skipped, a cluster is never collected twice at the same time
+        nextRun += fleet['interval']
+
+        while nextRun < loop.time():
+            nextRun += fleet['interval']
+
+
+# Number of virtual nodes of each instance on the hash ring, the clusters are spread evenly over the instances
+fleetVirtualNodes = 64
+
+
+def getFleetHash(value):
+
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+# Read a member or lease file of the coordination folder, None if it doesn't exist or is being written
+def readFleetFile(filename):
+
+    try:
+        with open(filename, 'r') as fileObject:
+            return json.load(fileObject)
+    except (OSError, ValueError):
+        return None
+
+
+def writeFleetFile(filename, data):
+
+    fileObject = open(filename + '.tmp', 'w')
+    json.dump(data, fileObject)
+    fileObject.close()
+
+    os.replace(filename + '.tmp', filename)
+
+
+# Write the heartbeat of the instance in the members folder of the coordination folder
+def registerFleetMember(fleet):
+
+    for folder in ('members', 'leases'):
+        if not os.path.isdir(os.path.join(fleet['coordination'], folder)):
+            os.makedirs(os.path.join(fleet['coordination'], folder), exist_ok=True)
+
+    member = {'instance': fleet['instance'], 'heartbeat': time.time()}
+
+    writeFleetFile(os.path.join(fleet['coordination'], 'members', fleet['instance']), member)
+
+
+# Remove the instance and its leases, its clusters are taken over at once by the other instances
+def unregisterFleetMember(fleet):
+
+    try:
+        os.remove(os.path.join(fleet['coordination'], 'members', fleet['instance']))
+
+        for filename in os.listdir(os.path.join(fleet['coordination'], 'leases')):
+            lease = readFleetFile(os.path.join(fleet['coordination'], 'leases', filename))
+
+            if lease is not None and lease['instance'] == fleet['instance']:
+                os.remove(os.path.join(fleet['coordination'], 'leases', filename))
+    except OSError as e:
+        print("FLEET - Caught exception: " + str(e))
+
+
+# Instances whose heartbeat is more recent than the member timeout
+def getFleetMembers(fleet):
+
+    members = set([fleet['instance']])
+    now = time.time()
+
+    for filename in os.listdir(os.path.join(fleet['coordination'], 'members')):
+        member = readFleetFile(os.path.join(fleet['coordination'], 'members', filename))
+
+        if member is not None and now - member['heartbeat'] < fleet['membertimeout']:
+            members.add(member['instance'])
+
+    return members
+
+
+# Owner of a cluster on the consistent hash ring of the instances
+# When an instance joins or dies, only the clusters of its part of the ring move
+def getFleetOwner(members, key):
+
+    ring = sorted((getFleetHash('%s#%i' % (member, i)), member) for member in members for i in range(fleetVirtualNodes))
+
+    index = bisect.bisect_left(ring, (getFleetHash(key), ''))
+
+    return ring[index % len(ring)][1]
+
+
+def getFleetLeaseFilename(fleet, args):
+
+    return os.path.join(fleet['coordination'], 'leases', hashlib.sha1((args.vcenter + '/' + args.clusterName).encode('utf-8')).hexdigest())
+
+
+def releaseFleetLease(fleet, args):
+
+    leasefilename = getFleetLeaseFilename(fleet, args)
+    lease = readFleetFile(leasefilename)
+
+    if lease is not None and lease['instance'] == fleet['instance']:
+        os.remove(leasefilename)
+
+
+# Take or renew the lease of a cluster, return False if the cluster must not be collected by this instance
+# and None if this instance owns the cluster but another instance still holds its lease
+# A lease lasts an interval plus the member timeout, it is taken over when it expires or when its instance is dead
+def acquireFleetLease(fleet, args):
+
+    try:
+        members = getFleetMembers(fleet)
+
+        if getFleetOwner(members, args.vcenter + '/' + args.clusterName) != fleet['instance']:
+            releaseFleetLease(fleet, args)
+            return False
+
+        leasefilename = getFleetLeaseFilename(fleet, args)
+
+        now = time.time()
+
+        lease = {}
+        lease['instance'] = fleet['instance']
+        lease['vcenter'] = args.vcenter
+        lease['cluster'] = args.clusterName
+        lease['expires'] = now + fleet['interval'] + fleet['membertimeout']
+
+        current = readFleetFile(leasefilename)
+
+        if current is not None and current['instance'] == fleet['instance']:
+            writeFleetFile(leasefilename, lease)
+            return True
+
+        if current is not None:
+
+            if current['expires'] > now and current['instance'] in members:
+                return None
+
+            # Only one instance can move the lease away, then the lease is created again
+            stalefilename = leasefilename + '.' + fleet['instance']
+
+            try:
+                os.rename(leasefilename, stalefilename)
+            except OSError:
+                return None
+
+            # Another instance took the lease over in the meantime, its lease is put back
+            if readFleetFile(stalefilename) != current:
+                try:
+                    os.link(stalefilename, leasefilename)
+                except OSError:
+                    pass
+                os.remove(stalefilename)
+                return None
+
+            os.remove(stalefilename)
+
+        try:
+            fd = os.open(leasefilename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+
+        os.write(fd, json.dumps(lease).encode('utf-8'))
+        os.close(fd)
+
+        return True
+    except OSError as e:
+        print("FLEET - Caught exception while acquiring the lease of cluster %s : %s" % (args.clusterName, str(e)))
+        return False
+
+
+# Release the leases of the clusters which moved to another instance, except the ones being collected
+# The new owner of a cluster doesn't wait for the next run of the previous one to take its lease
+def releaseFleetLeases(fleet):
+
+    members = getFleetMembers(fleet)
+
+    for filename in os.listdir(os.path.join(fleet['coordination'], 'leases')):
+        leasefilename = os.path.join(fleet['coordination'], 'leases', filename)
+        lease = readFleetFile(leasefilename)
+
+        if lease is None or lease['instance'] != fleet['instance']:
+            continue
+
+        key = lease['vcenter'] + '/' + lease['cluster']
+
+        if key not in fleet['collecting'] and getFleetOwner(members, key) != fleet['instance']:
+            os.remove(leasefilename)
+
+
+async def runFleetHeartbeat(fleet):
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        try:
+            await loop.run_in_executor(None, registerFleetMember, fleet)
+            await loop.run_in_executor(None, releaseFleetLeases, fleet)
+        except OSError as e:
+            print("FLEET - Caught exception: " + str(e))
+
+        await asyncio.sleep(fleet['membertimeout'] / 3.0)
+
+
+async def runFleetEngine(fleet):
+
+    semaphores = {}
+    semaphores['fleet'] = asyncio.Semaphore(fleet['concurrency'])
+
+    sessions = {}
+
+    for vcenter, options in fleet['vcenters'].items():
+        semaphores[vcenter] = asyncio.Semaphore(options['concurrency'])
+        sessions[vcenter] = {'lock': threading.Lock(), 'si': None, 'clusters': {}}
+
+        # The current session of each vCenter is disconnected at exit
+        atexit.register(closeFleetSession, sessions[vcenter])
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Blocking pyVmomi calls run in the threads of the executor
+    executor = ThreadPoolExecutor(max_workers=fleet['concurrency'])
+
+    schedule = getFleetSchedule(fleet)
+
+    heartbeat = None
+
+    if fleet['coordination']:
+        registerFleetMember(fleet)
+        heartbeat = asyncio.ensure_future(runFleetHeartbeat(fleet))
+
+        # In once mode, the member file is kept: the instances running at the same interval share the clusters
+        if not fleet['once']:
+            atexit.register(unregisterFleetMember, fleet)
+
+    tasks = []
+
+    for i, args in enumerate(schedule):
+        # In once mode, all the clusters are collected as soon as possible
+        offset = 0 if fleet['once'] else i * float(fleet['interval']) / len(schedule)
+
+        tasks.append(runFleetCluster(args, offset, fleet, semaphores, sessions, executor))
+
+    await asyncio.gather(*tasks)
+
+    if heartbeat is not None:
+        heartbeat.cancel()
+
+        try:
+            await heartbeat
+        except asyncio.CancelledError:
+            pass
+
+    executor.shutdown()
+
+
+# Collect all the vCenters and clusters of the fleet configuration file from one process
+def runFleet(filename):
+
+    loadFleetModules()
+
+    try:
+        fleet = readFleetConfig(filename)
+    except Exception as e:
+        print("FLEET - Caught exception: " + str(e))
+        return 1
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(runFleetEngine(fleet))
+    loop.close()
+
+    return 0
+
+
+# Main...
+def main():
+
+    # Parse CLI arguments
+    args = get_args()
+
+    if args.fleet:
+        return runFleet(args.fleet)
+
+    collectCluster(args)
+
+    return 0
+
+# Start program
+if __name__ == "__main__":
+    exit(main())